@@ -0,0 +1,28 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Yes/no values of board and project options, e.g. "board_build.xxx = yes".
+"""
+
+ENABLED = ("1", "y", "yes", "true", "on")
+DISABLED = ("", "0", "n", "no", "false", "off")
+
+
+def is_enabled(value):
+    return str(value).strip().lower() in ENABLED
+
+
+def is_disabled(value):
+    return str(value).strip().lower() in DISABLED
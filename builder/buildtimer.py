@@ -0,0 +1,150 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Per-command timing of a build, implemented as a wrapper around $SPAWN.
+
+On POSIX systems every command is started by the wrapper itself, so the
+peak RSS of each compiler/linker process (including its own children such
+as cc1plus, collect2 or lto1) is taken from os.wait4(). Other systems fall
+back to the original spawn function and report wall time only.
+"""
+
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from os.path import basename, getsize, isfile
+
+SOURCE_SUFFIXES = (".c", ".cc", ".cpp", ".cxx", ".S", ".s", ".ino")
+TIME_REPORT_RE = re.compile(
+    r"^\s*(phase [\w ]+?|TOTAL)\s*:\s*[\d.]+\s*(?:\(\s*\d+%\)\s*)?"
+    r"[\d.]+\s*(?:\(\s*\d+%\)\s*)?([\d.]+)")
+
+
+def _classify(args):
+    tool = basename(args[0].strip("\"'"))
+    if tool.endswith(("-ar", "-gcc-ar", "ar")) or "ranlib" in tool:
+        return "archive"
+    if "-c" in args:
+        return "compile"
+    return "link"
+
+
+def _find_output(args):
+    for i, arg in enumerate(args):
+        if arg == "-o" and i + 1 < len(args):
+            return args[i + 1].strip("\"'")
+        if arg.startswith("-o") and len(arg) > 2:
+            return arg[2:].strip("\"'")
+    if _classify(args) == "archive" and len(args) > 2:
+        return args[2].strip("\"'")
+    return None
+
+
+def _find_source(args):
+    for arg in reversed(args):
+        if arg.strip("\"'").endswith(SOURCE_SUFFIXES):
+            return arg.strip("\"'")
+    return None
+
+
+def parse_time_report(text):
+    """Return ({phase: wall seconds}, remaining text) from -ftime-report"""
+    phases = {}
+    lines = []
+    in_report = False
+    for line in text.splitlines(True):
+        if line.startswith("Time variable"):
+            in_report = True
+            continue
+        match = TIME_REPORT_RE.match(line)
+        if match:
+            phases[match.group(1)] = float(match.group(2))
+            if match.group(1) == "TOTAL":
+                in_report = False
+            continue
+        if not in_report:
+            lines.append(line)
+    return phases, "".join(lines)
+
+
+class BuildTimer(object):
+
+    def __init__(self, spawn, capture_time_report=False):
+        self._spawn = spawn
+        self.capture_time_report = capture_time_report
+        self.records = []
+        self._lock = threading.Lock()
+
+    def spawn(self, sh, escape, cmd, args, env):
+        start = time.time()
+        max_rss = None
+        phases = {}
+        if os.name == "posix" and hasattr(os, "wait4"):
+            proc = subprocess.Popen(
+                [sh, "-c", " ".join(args)], env=env,
+                stderr=subprocess.PIPE if self.capture_time_report else None,
+                universal_newlines=True)
+            stderr = proc.stderr.read() if proc.stderr else ""
+            _, status, rusage = os.wait4(proc.pid, 0)
+            proc.returncode = returncode = (
+                -os.WTERMSIG(status) if os.WIFSIGNALED(status)
+                else os.WEXITSTATUS(status))
+            # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+            max_rss = rusage.ru_maxrss * (
+                1 if sys.platform == "darwin" else 1024)
+            phases, stderr = parse_time_report(stderr)
+            if stderr.strip():
+                sys.stderr.write(stderr)
+        else:
+            returncode = self._spawn(sh, escape, cmd, args, env)
+
+        output = _find_output(args)
+        with self._lock:
+            self.records.append(dict(
+                phase=_classify(args),
+                source=_find_source(args),
+                target=output,
+                wall=round(time.time() - start, 4),
+                max_rss=max_rss,
+                size=getsize(output) if output and isfile(output) else None,
+                time_report=phases or None,
+            ))
+        return returncode
+
+    def write_report(self, path):
+        with open(path, "w") as fp:
+            json.dump(self.records, fp, indent=2)
+
+    def summary(self, top=10):
+        totals = {}
+        for record in self.records:
+            totals[record["phase"]] = totals.get(record["phase"], 0) + (
+                record["wall"])
+        lines = ["Build time by phase: " + ", ".join(
+            "%s %.1fs" % item for item in sorted(totals.items()))]
+        lines.append("Slowest %d commands:" % top)
+        for record in sorted(
+                self.records, key=lambda r: r["wall"], reverse=True)[:top]:
+            lines.append("  %7.2fs  %8s  %-8s %s" % (
+                record["wall"],
+                "%dM" % (record["max_rss"] // (1024 * 1024))
+                if record["max_rss"] else "-",
+                record["phase"],
+                record["source"] or record["target"] or "-"))
+        return "\n".join(lines)
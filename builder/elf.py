@@ -0,0 +1,323 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Minimal ELF reader and in-process replacement for the objcopy conversions
+used by the builder (ELF -> Intel HEX, raw binary and AVR EEPROM image).
+
+The output follows the rules of the BFD "ihex" and "binary" back-ends, so
+the generated files are byte-identical to the ones produced by objcopy.
+"""
+
+import mmap
+import os
+import struct
+from collections import namedtuple
+
+SHT_NOBITS = 8
+SHT_SYMTAB = 2
+SHF_ALLOC = 0x2
+SHF_EXECINSTR = 0x4
+PT_LOAD = 1
+STT_FUNC = 2
+STT_OBJECT = 1
+
+Section = namedtuple(
+    "Section", "name type flags addr offset size link entsize lma")
+Segment = namedtuple("Segment", "type offset vaddr paddr filesz memsz flags")
+Symbol = namedtuple("Symbol", "name value size type bind shndx")
+
+
+class ElfError(Exception):
+    pass
+
+
+class ElfFile(object):
+
+    def __init__(self, path):
+        self.path = path
+        self._fp = open(path, "rb")
+        try:
+            self.data = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            self._fp.close()
+            raise ElfError("%s is not an ELF file" % path)
+        if self.data[:4] != b"\x7fELF":
+            self.close()
+            raise ElfError("%s is not an ELF file" % path)
+        self.is64 = self.data[4] == 2
+        self.endian = "<" if self.data[5] == 1 else ">"
+        self._parse_header()
+        self.segments = self._parse_segments()
+        self.sections = self._parse_sections()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if getattr(self, "data", None) is not None:
+            self.data.close()
+            self.data = None
+        self._fp.close()
+
+    def _unpack(self, fmt, offset):
+        return struct.unpack_from(self.endian + fmt, self.data, offset)
+
+    def _parse_header(self):
+        if self.is64:
+            fields = self._unpack("HHIQQQIHHHHHH", 16)
+        else:
+            fields = self._unpack("HHIIIIIHHHHHH", 16)
+        (self.e_type, self.machine, _, self.entry, self._phoff, self._shoff,
+         self.e_flags, _, self._phentsize, self._phnum, self._shentsize,
+         self._shnum, self._shstrndx) = fields
+
+    def _parse_segments(self):
+        result = []
+        for i in range(self._phnum):
+            offset = self._phoff + i * self._phentsize
+            if self.is64:
+                (p_type, p_flags, p_offset, p_vaddr, p_paddr, p_filesz,
+                 p_memsz, _) = self._unpack("IIQQQQQQ", offset)
+            else:
+                (p_type, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz,
+                 p_flags, _) = self._unpack("IIIIIIII", offset)
+            result.append(Segment(p_type, p_offset, p_vaddr, p_paddr,
+                                  p_filesz, p_memsz, p_flags))
+        return result
+
+    def _parse_sections(self):
+        raw = []
+        for i in range(self._shnum):
+            offset = self._shoff + i * self._shentsize
+            if self.is64:
+                fields = self._unpack("IIQQQQIIQQ", offset)
+            else:
+                fields = self._unpack("IIIIIIIIII", offset)
+            raw.append(fields)
+        if not raw:
+            return []
+        strtab_offset = raw[self._shstrndx][4]
+        result = []
+        for (name, sh_type, flags, addr, offset, size, link, _, _,
+             entsize) in raw:
+            result.append(Section(
+                self._cstring(strtab_offset + name), sh_type, flags, addr,
+                offset, size, link, entsize,
+                self._section_lma(sh_type, flags, addr, offset, size)))
+        return result
+
+    def _section_lma(self, sh_type, flags, addr, offset, size):
+        # the same rule BFD applies to derive a section LMA from the
+        # program headers (see "_bfd_elf_make_section_from_shdr")
+        if not flags & SHF_ALLOC:
+            return addr
+        loads = [seg for seg in self.segments
+                 if seg.type == PT_LOAD and seg.memsz]
+        if len(loads) > 1 and not any(seg.paddr for seg in self.segments):
+            return addr
+        for seg in self.segments:
+            if seg.type != PT_LOAD:
+                continue
+            if not seg.vaddr <= addr <= seg.vaddr + seg.memsz - size:
+                continue
+            if sh_type == SHT_NOBITS:
+                return seg.paddr + addr - seg.vaddr
+            if seg.offset <= offset <= seg.offset + seg.filesz - size:
+                return seg.paddr + offset - seg.offset
+        return addr
+
+    def _cstring(self, offset):
+        end = self.data.find(b"\0", offset)
+        return self.data[offset:end].decode("utf-8", "replace")
+
+    def get_section(self, name):
+        for section in self.sections:
+            if section.name == name:
+                return section
+        return None
+
+    def section_data(self, section):
+        if section.type == SHT_NOBITS:
+            return b"\0" * section.size
+        return self.data[section.offset:section.offset + section.size]
+
+    def symbols(self):
+        result = []
+        for section in self.sections:
+            if section.type != SHT_SYMTAB or not section.entsize:
+                continue
+            strtab = self.sections[section.link]
+            for i in range(section.size // section.entsize):
+                offset = section.offset + i * section.entsize
+                if self.is64:
+                    name, info, _, shndx, value, size = self._unpack(
+                        "IBBHQQ", offset)
+                else:
+                    name, value, size, info, _, shndx = self._unpack(
+                        "IIIBBH", offset)
+                if not name:
+                    continue
+                result.append(Symbol(
+                    self._cstring(strtab.offset + name), value, size,
+                    info & 0xF, info >> 4, shndx))
+        return result
+
+
+def loadable_chunks(elf, only=None, remove=None, change_lma=None,
+                    load=None):
+    """
+    Return (lma, data) pairs for the sections objcopy would emit, sorted by
+    address. `only` and `remove` mimic "-j" and "-R", `change_lma` maps a
+    section name to a new LMA like "--change-section-lma NAME=VALUE" and
+    `load` lists the sections of "--set-section-flags NAME=alloc,load".
+    """
+    change_lma = change_lma or {}
+    load = load or ()
+    result = []
+    for section in elf.sections:
+        if only is not None:
+            if section.name not in only:
+                continue
+        elif remove and section.name in remove:
+            continue
+        if not section.size:
+            continue
+        if section.name not in load and (not section.flags & SHF_ALLOC
+                                         or section.type == SHT_NOBITS):
+            continue
+        lma = change_lma.get(section.name, section.lma)
+        result.append((lma, elf.section_data(section)))
+    return sorted(result, key=lambda item: item[0])
+
+
+def _ihex_record(rec_type, address, data=b""):
+    record = bytearray([len(data), (address >> 8) & 0xFF, address & 0xFF,
+                        rec_type])
+    record.extend(data)
+    checksum = (-sum(record)) & 0xFF
+    return ":%s%02X\r\n" % (bytes(record).hex().upper(), checksum)
+
+
+def to_ihex(chunks, start_address=0):
+    lines = []
+    segbase = 0
+    extbase = 0
+    for where, data in chunks:
+        pos = 0
+        count = len(data)
+        while count > 0:
+            now = min(count, 16)
+            if where > segbase + extbase + 0xFFFF:
+                if extbase == 0 and where <= 0xFFFFF:
+                    segbase = where & 0xF0000
+                    lines.append(_ihex_record(
+                        2, 0, bytes([(segbase >> 12) & 0xFF,
+                                     (segbase >> 4) & 0xFF])))
+                else:
+                    if segbase != 0:
+                        lines.append(_ihex_record(2, 0, b"\0\0"))
+                        segbase = 0
+                    extbase = where & 0xFFFF0000
+                    lines.append(_ihex_record(
+                        4, 0, bytes([(extbase >> 24) & 0xFF,
+                                     (extbase >> 16) & 0xFF])))
+            rec_addr = where - (extbase + segbase)
+            if rec_addr + now > 0xFFFF:
+                now = 0x10000 - rec_addr
+            lines.append(_ihex_record(0, rec_addr, data[pos:pos + now]))
+            where += now
+            pos += now
+            count -= now
+
+    if start_address:
+        if start_address <= 0xFFFFF:
+            lines.append(_ihex_record(3, 0, bytes([
+                (start_address & 0xF0000) >> 12 & 0xFF, 0,
+                (start_address >> 8) & 0xFF, start_address & 0xFF])))
+        else:
+            lines.append(_ihex_record(
+                5, 0, struct.pack(">I", start_address & 0xFFFFFFFF)))
+    lines.append(_ihex_record(1, 0))
+    return "".join(lines).encode("ascii")
+
+
+def to_binary(chunks):
+    if not chunks:
+        return b""
+    base = chunks[0][0]
+    end = max(lma + len(data) for lma, data in chunks)
+    image = bytearray(end - base)
+    for lma, data in chunks:
+        image[lma - base:lma - base + len(data)] = data
+    return bytes(image)
+
+
+def parse_objcopy_flags(flags):
+    """
+    Return the image options of objcopy `flags`. Raises ValueError for the
+    options the native conversion doesn't implement.
+    """
+    options = dict(output=None, only=None, remove=[], change_lma={}, load=[])
+    items = list(flags)
+    while items:
+        flag = items.pop(0)
+        if flag in ("-O", "-R", "-j", "--change-section-lma") and not items:
+            raise ValueError("`%s` needs an argument" % flag)
+        if flag == "-O":
+            options["output"] = items.pop(0)
+        elif flag == "-R":
+            options["remove"].append(items.pop(0))
+        elif flag == "-j":
+            options["only"] = (options["only"] or []) + [items.pop(0)]
+        elif flag == "--change-section-lma":
+            argument = items.pop(0)
+            name, _, value = argument.partition("=")
+            try:
+                options["change_lma"][name] = int(value, 0)
+            except ValueError:
+                raise ValueError("unsupported `%s %s`" % (flag, argument))
+        elif flag.startswith("--set-section-flags="):
+            name, _, value = flag.split("=", 1)[1].partition("=")
+            if set(value.strip("\"'").split(",")) != set(["alloc", "load"]):
+                raise ValueError("unsupported `%s`" % flag)
+            options["load"].append(name)
+        elif flag != "--no-change-warnings":
+            raise ValueError("unsupported `%s`" % flag)
+    if options["output"] not in ("ihex", "binary"):
+        raise ValueError("unsupported output format `%s`" % options["output"])
+    return options
+
+
+def convert(elf_path, images):
+    """
+    Write every (path, options) of `images`, with options as returned by
+    parse_objcopy_flags(), from a single mapping of the ELF file
+    """
+    with ElfFile(elf_path) as elf:
+        outputs = []
+        for path, options in images:
+            chunks = loadable_chunks(
+                elf, options["only"], options["remove"],
+                options["change_lma"], options["load"])
+            outputs.append((path, to_ihex(chunks, elf.entry) if (
+                options["output"] == "ihex") else to_binary(chunks)))
+    for path, content in outputs:
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, "wb") as fp:
+            fp.write(content)
+        os.replace(tmp_path, path)
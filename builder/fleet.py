@@ -0,0 +1,89 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Upload one firmware image to many attached Teensy boards in parallel.
+
+"teensy_loader_cli" cannot address a board by its serial number, so fleet
+uploads go through a loader that can (TyTools "tycmd" by default). The
+loader executable and its arguments are configurable, which also allows
+a stand-in script to be used for testing without hardware.
+"""
+
+import json
+import shlex
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def parse_device_list(output):
+    """
+    Parse "tycmd list" output, either JSON (one object per line or a list)
+    or the plain "add <serial>-<model> <location> <description>" format.
+    """
+    devices = []
+    output = output.strip()
+    try:
+        items = json.loads(output)
+        items = items if isinstance(items, list) else [items]
+    except ValueError:
+        items = []
+        for line in output.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                items.append(json.loads(line))
+                continue
+            except ValueError:
+                pass
+            tokens = line.split(None, 3)
+            if len(tokens) < 2 or tokens[0] not in ("add", "change"):
+                continue
+            items.append(dict(
+                serial=tokens[1].split("-", 1)[0],
+                model=tokens[3] if len(tokens) > 3 else ""))
+    for item in items:
+        if item.get("action", "add") not in ("add", "change"):
+            continue
+        serial = str(item.get("serial") or item.get("tag", "").split("-")[0])
+        if serial and serial not in [d["serial"] for d in devices]:
+            devices.append(dict(serial=serial, model=item.get("model", "")))
+    return devices
+
+
+def discover(loader, list_args, model=None, env=None):
+    output = subprocess.run(
+        [loader] + shlex.split(list_args), stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT, universal_newlines=True, env=env).stdout
+    return [
+        d["serial"] for d in parse_device_list(output)
+        if not model or not d["model"] or d["model"] == model]
+
+
+def flash(serials, loader, args_template, firmware, jobs=4, env=None):
+    def _flash(serial):
+        cmd = [loader] + [
+            arg.format(serial=serial, firmware=firmware)
+            for arg in shlex.split(args_template)]
+        start = time.time()
+        proc = subprocess.run(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            universal_newlines=True, env=env)
+        return dict(serial=serial, returncode=proc.returncode,
+                    duration=time.time() - start, output=proc.stdout)
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        return list(executor.map(_flash, serials))
@@ -22,11 +22,14 @@ kinds of creative coding, interactive objects, spaces or physical experiences.
 http://arduino.cc/en/Reference/HomePage
 """
 
-from io import open
-from os import listdir
+import hashlib
+import json
+import os
+import shutil
+import sys
 from os.path import isdir, isfile, join
 
-from SCons.Script import DefaultEnvironment
+from SCons.Script import COMMAND_LINE_TARGETS, DefaultEnvironment
 
 env = DefaultEnvironment()
 platform = env.PioPlatform()
@@ -37,6 +40,69 @@ BUILD_CORE = env.BoardConfig().get("build.core")
 
 assert isdir(FRAMEWORK_DIR)
 
+
+def prepare_core_overlay(core_dir, overlay_dir):
+    """
+    Mirror the Teensy 2.x core into `overlay_dir` with relative includes
+    rewritten. A manifest of source mtimes/sizes lets unchanged files be
+    skipped with a single stat() call, so the installed package is never
+    modified and a no-op build does not read any core source.
+    """
+    manifest_path = join(overlay_dir, ".manifest.json")
+    manifest = {}
+    if isfile(manifest_path):
+        try:
+            with open(manifest_path) as fp:
+                manifest = json.load(fp)
+        except ValueError:
+            pass
+    if manifest.get("version") != FRAMEWORK_VERSION:
+        manifest = {}
+    known_files = manifest.get("files", {})
+
+    files = {}
+    changed = False
+    for root, _, names in os.walk(core_dir):
+        rel_dir = os.path.relpath(root, core_dir)
+        for name in names:
+            rel_path = os.path.normpath(join(rel_dir, name)).replace("\\", "/")
+            src_path = join(root, name)
+            dst_path = join(overlay_dir, rel_path)
+            st = os.stat(src_path)
+            stamp = [st.st_mtime, st.st_size]
+            entry = known_files.get(rel_path)
+            if entry and entry[:2] == stamp and isfile(dst_path):
+                files[rel_path] = entry
+                continue
+
+            with open(src_path, "rb") as fp:
+                content = fp.read()
+            # search relative includes in teensy directories
+            if rel_dir == ".":
+                content = content.replace(b'#include "../', b'#include "')
+            if not isdir(os.path.dirname(dst_path)):
+                os.makedirs(os.path.dirname(dst_path))
+            with open(dst_path, "wb") as fp:
+                fp.write(content)
+            files[rel_path] = stamp + [hashlib.sha1(content).hexdigest()]
+            changed = True
+
+    for rel_path in set(known_files) - set(files):
+        if isfile(join(overlay_dir, rel_path)):
+            os.remove(join(overlay_dir, rel_path))
+        changed = True
+
+    if changed or not isfile(manifest_path):
+        with open(manifest_path, "w") as fp:
+            json.dump(dict(version=FRAMEWORK_VERSION, files=files), fp)
+    return overlay_dir
+
+
+CORE_DIR = join(FRAMEWORK_DIR, "cores", BUILD_CORE)
+if BUILD_CORE == "teensy":
+    CORE_DIR = prepare_core_overlay(
+        CORE_DIR, join(env.subst("$BUILD_DIR"), "FrameworkArduinoCore"))
+
 BUILTIN_USB_FLAGS = (
     "USB_SERIAL",
     "USB_DUAL_SERIAL",
@@ -71,6 +137,13 @@ env.Replace(
     SIZEDATAREGEXP=r"^(?:\.usbdescriptortable|\.dmabuffers|\.usbbuffers|\.data|\.bss|\.noinit|\.text\.itcm|\.text\.itcm\.padding)\s+([0-9]+).*"
 )
 
+# Flash sections of the Teensy 4 linker scripts ("headers" and "code" of
+# teensy_size), the unwind table is loaded to ITCM from flash as well
+if BUILD_CORE == "teensy4":
+    env.Replace(
+        SIZEPROGREGEXP=r"^(?:\.text\.headers|\.text\.code|\.text\.progmem|\.text\.itcm|\.ARM\.exidx|\.data|\.text\.csf)\s+([0-9]+).*"
+    )
+
 env.Append(
     CPPDEFINES=[
         ("ARDUINO", 10805),
@@ -79,7 +152,7 @@ env.Append(
     ],
 
     CPPPATH=[
-        join(FRAMEWORK_DIR, "cores", BUILD_CORE)
+        CORE_DIR
     ],
 
     LIBSOURCE_DIRS=[
@@ -87,6 +160,74 @@ env.Append(
     ]
 )
 
+# Optimization profiles selected by "-D TEENSY_OPT_<NAME>" or by the
+# "board_build.arduino.opt_profile = <NAME>" option. The first matching
+# define wins. Projects may declare extra profiles in sections named
+# "[teensy_opt_profile:<NAME>]" with "ccflags", "linkflags", "cppdefines"
+# and "lto" options.
+OPTIMIZATION_PROFILES = [
+    ("FASTER_LTO", dict(ccflags=["-O2"], linkflags=["-O2"], lto=True)),
+    ("FASTER_NANOLIBC", dict(
+        ccflags=["-O2"], linkflags=["-O2", "--specs=nano.specs"])),
+    ("FASTER_LTO_NANOLIBC", dict(
+        ccflags=["-O2"], linkflags=["-O2", "--specs=nano.specs"], lto=True)),
+    ("FAST", dict(ccflags=["-O1"], linkflags=["-O1"])),
+    ("FAST_LTO", dict(ccflags=["-O1"], linkflags=["-O1"], lto=True)),
+    ("FASTEST", dict(ccflags=["-O3"], linkflags=["-O3"])),
+    ("FASTEST_LTO", dict(ccflags=["-O3"], linkflags=["-O3"], lto=True)),
+    ("FASTEST_PURE_CODE", dict(
+        ccflags=["-O3", "-mpure-code"], linkflags=["-O3", "-mpure-code"],
+        cppdefines=["__PURE_CODE__"])),
+    ("FASTEST_PURE_CODE_LTO", dict(
+        ccflags=["-O3", "-mpure-code"], linkflags=["-O3", "-mpure-code"],
+        cppdefines=["__PURE_CODE__"], lto=True)),
+    ("DEBUG", dict(ccflags=["-g", "-Og"], linkflags=["-g", "-Og"])),
+    ("DEBUG_LTO", dict(
+        ccflags=["-g", "-Og"], linkflags=["-g", "-Og"], lto=True)),
+    ("SMALLEST_CODE_LTO", dict(
+        ccflags=["-Os", "--specs=nano.specs"],
+        linkflags=["-Os", "--specs=nano.specs"], lto=True)),
+    ("FASTER", dict(ccflags=["-O2"], linkflags=["-O2"])),
+    ("SMALLEST_CODE", dict(
+        ccflags=["-Os", "--specs=nano.specs"],
+        linkflags=["-Os", "--specs=nano.specs"])),
+]
+
+
+def get_optimization_profiles():
+    profiles = list(OPTIMIZATION_PROFILES)
+    config = env.GetProjectConfig()
+    for section in config.sections():
+        if not section.startswith("teensy_opt_profile:"):
+            continue
+        profile = {}
+        for option in ("ccflags", "linkflags", "cppdefines"):
+            if config.has_option(section, option):
+                profile[option] = config.get(section, option).split()
+        if config.has_option(section, "lto"):
+            profile["lto"] = env.IsEnabled(config.get(section, "lto"))
+        name = section.split(":", 1)[1].strip().upper()
+        profiles = [(n, p) for n, p in profiles if n != name]
+        profiles.insert(0, (name, profile))
+    return profiles
+
+
+def get_optimization_profile():
+    profiles = get_optimization_profiles()
+    selected = env.BoardConfig().get("build.arduino.opt_profile", "").upper()
+    for name, profile in profiles:
+        if name == selected or (
+                not selected and "TEENSY_OPT_%s" % name in env["CPPDEFINES"]):
+            return profile
+    if selected:
+        sys.stderr.write(
+            "Error: Unknown optimization profile `%s`\n" % selected)
+        env.Exit(1)
+    # default profiles: for Teensy LC => SMALLEST_CODE, others => FASTER
+    default = "SMALLEST_CODE" if env.BoardConfig().id_ == "teensylc" else "FASTER"
+    return dict(profiles)[default]
+
+
 if "BOARD" in env and BUILD_CORE == "teensy":
     env.Append(
         ASFLAGS=[
@@ -179,6 +320,16 @@ elif "BOARD" in env and BUILD_CORE in ("teensy3", "teensy4"):
     if not env.BoardConfig().get("build.ldscript", ""):
         env.Replace(LDSCRIPT_PATH=env.BoardConfig().get("build.arduino.ldscript", ""))
 
+    if env.IsEnabled(env.BoardConfig().get("build.arduino.hot_placement", "no")):
+        if BUILD_CORE != "teensy4":
+            sys.stderr.write(
+                "Error: Hot function placement needs the ITCM of Teensy 4.x\n")
+            env.Exit(1)
+        ldscript = env.subst("$LDSCRIPT_PATH")
+        if not isfile(ldscript):
+            ldscript = join(FRAMEWORK_DIR, "cores", BUILD_CORE, ldscript)
+        env.Replace(LDSCRIPT_PATH=env.PlaceHotFunctions(ldscript))
+
     if env.BoardConfig().id_ in (
         "teensy35",
         "teensy36",
@@ -207,92 +358,26 @@ elif "BOARD" in env and BUILD_CORE in ("teensy3", "teensy4"):
         )
 
     # Optimization
-    if "TEENSY_OPT_FASTER_LTO" in env['CPPDEFINES']:
-        env.Append(
-            CCFLAGS=["-O2", "-flto=auto", "-fno-fat-lto-objects"],
-            LINKFLAGS=["-O2", "-flto=auto", "-fno-fat-lto-objects", "-fuse-linker-plugin"]
-        )
-    elif "TEENSY_OPT_FASTER_NANOLIBC" in env['CPPDEFINES']:
-        env.Append(
-            CCFLAGS=["-O2"],
-            LINKFLAGS=["-O2", "--specs=nano.specs"]
-        )
-    elif "TEENSY_OPT_FASTER_LTO_NANOLIBC" in env['CPPDEFINES']:
-        env.Append(
-            CCFLAGS=["-O2", "-flto=auto", "-fno-fat-lto-objects"],
-            LINKFLAGS=["-O2", "-flto=auto", "-fno-fat-lto-objects", "-fuse-linker-plugin", "--specs=nano.specs"]
-        )
-    elif "TEENSY_OPT_FAST" in env['CPPDEFINES']:
-        env.Append(
-            CCFLAGS=["-O1"],
-            LINKFLAGS=["-O1"]
-        )
-    elif "TEENSY_OPT_FAST_LTO" in env['CPPDEFINES']:
-        env.Append(
-            CCFLAGS=["-O1", "-flto=auto", "-fno-fat-lto-objects"],
-            LINKFLAGS=["-O1", "-flto=auto", "-fno-fat-lto-objects", "-fuse-linker-plugin"]
-        )
-    elif "TEENSY_OPT_FASTEST" in env['CPPDEFINES']:
-        env.Append(
-            CCFLAGS=["-O3"],
-            LINKFLAGS=["-O3"]
-        )
-    elif "TEENSY_OPT_FASTEST_LTO" in env['CPPDEFINES']:
-        env.Append(
-            CCFLAGS=["-O3", "-flto=auto", "-fno-fat-lto-objects"],
-            LINKFLAGS=["-O3", "-flto=auto", "-fno-fat-lto-objects", "-fuse-linker-plugin"]
-        )
-    elif "TEENSY_OPT_FASTEST_PURE_CODE" in env['CPPDEFINES']:
-        env.Append(
-            CCFLAGS=["-O3", "-mpure-code"],
-            CPPDEFINES=["__PURE_CODE__"],
-            LINKFLAGS=["-O3", "-mpure-code"]
-        )
-    elif "TEENSY_OPT_FASTEST_PURE_CODE_LTO" in env['CPPDEFINES']:
-        env.Append(
-            CCFLAGS=["-O3", "-mpure-code", "-flto=auto", "-fno-fat-lto-objects"],
-            CPPDEFINES=["__PURE_CODE__"],
-            LINKFLAGS=["-O3", "-mpure-code", "-flto=auto", "-fno-fat-lto-objects", "-fuse-linker-plugin"]
-        )
-    elif "TEENSY_OPT_DEBUG" in env['CPPDEFINES']:
-        env.Append(
-            CCFLAGS=["-g", "-Og"],
-            LINKFLAGS=["-g", "-Og"]
-        )
-    elif "TEENSY_OPT_DEBUG_LTO" in env['CPPDEFINES']:
-        env.Append(
-            CCFLAGS=["-g", "-Og", "-flto=auto", "-fno-fat-lto-objects"],
-            LINKFLAGS=["-g", "-Og", "-flto=auto", "-fno-fat-lto-objects", "-fuse-linker-plugin"]
-        )
-    elif "TEENSY_OPT_SMALLEST_CODE_LTO" in env['CPPDEFINES']:
-        env.Append(
-            CCFLAGS=["-Os", "--specs=nano.specs", "-flto=auto", "-fno-fat-lto-objects"],
-            LINKFLAGS=["-Os", "--specs=nano.specs", "-flto=auto", "-fno-fat-lto-objects", "-fuse-linker-plugin"]
-        )
-    elif "TEENSY_OPT_FASTER" in env['CPPDEFINES']:
-        env.Append(
-            CCFLAGS=["-O2"],
-            LINKFLAGS=["-O2"]
-        )
-    elif "TEENSY_OPT_SMALLEST_CODE" in env['CPPDEFINES']:
-        env.Append(
-            CCFLAGS=["-Os", "--specs=nano.specs"],
-            LINKFLAGS=["-Os", "--specs=nano.specs"]
-        )
-    # default profiles
-    else:
-        # for Teensy LC => TEENSY_OPT_SMALLEST_CODE
-        if env.BoardConfig().id_ == "teensylc":
-            env.Append(
-                CCFLAGS=["-Os", "--specs=nano.specs"],
-                LINKFLAGS=["-Os", "--specs=nano.specs"]
-            )
-        # for others => TEENSY_OPT_FASTER
-        else:
-            env.Append(
-                CCFLAGS=["-O2"],
-                LINKFLAGS=["-O2"]
-            )
+    env.Replace(ARDUINO_OPT_PROFILES=[
+        name for name, _ in get_optimization_profiles()])
+    profile = get_optimization_profile()
+    lto_ccflags = []
+    lto_linkflags = []
+    if profile.get("lto"):
+        # "auto" uses one LTRANS job per CPU, partitions are "balanced",
+        # "1to1", "max", "one" or "none"
+        lto_jobs = env.BoardConfig().get("build.arduino.lto_jobs", "auto")
+        lto_partition = env.BoardConfig().get(
+            "build.arduino.lto_partition", "")
+        lto_ccflags = ["-flto=%s" % lto_jobs, "-fno-fat-lto-objects"]
+        lto_linkflags = lto_ccflags + ["-fuse-linker-plugin"]
+        if lto_partition:
+            lto_linkflags.append("-flto-partition=%s" % lto_partition)
+    env.Append(
+        CCFLAGS=profile.get("ccflags", []) + lto_ccflags,
+        CPPDEFINES=profile.get("cppdefines", []),
+        LINKFLAGS=profile.get("linkflags", []) + lto_linkflags
+    )
 
 
 cpu = env.BoardConfig().get("build.cpu", "")
@@ -327,33 +412,64 @@ if "cortex-m" in cpu:
 # Teensy 2.x Core
 if BUILD_CORE == "teensy":
     env.Append(CPPPATH=[join(FRAMEWORK_DIR, "cores")])
-
-    # search relative includes in teensy directories
-    core_dir = join(FRAMEWORK_DIR, "cores", "teensy")
-    for item in sorted(listdir(core_dir)):
-        file_path = join(core_dir, item)
-        if not isfile(file_path):
-            continue
-        content = None
-        content_changed = False
-        with open(file_path, encoding="latin-1") as fp:
-            content = fp.read()
-            if '#include "../' in content:
-                content_changed = True
-                content = content.replace('#include "../', '#include "')
-        if not content_changed:
-            continue
-        with open(file_path, "w", encoding="latin-1") as fp:
-            fp.write(content)
 else:
     env.Prepend(LIBPATH=[join(FRAMEWORK_DIR, "cores", BUILD_CORE)])
 
+#
+# Profile-guided optimization
+#
+
+PGO_MODE = env.BoardConfig().get("build.arduino.pgo", "")
+pgo_runtime_env = None
+if PGO_MODE:
+    if BUILD_CORE not in ("teensy3", "teensy4"):
+        sys.stderr.write(
+            "Error: PGO is supported only by the teensy3/teensy4 cores\n")
+        env.Exit(1)
+    pgo_dir = env.subst(env.BoardConfig().get(
+        "build.arduino.pgo_dir", join("$PROJECT_DIR", "pgo", "$PIOENV")))
+    env.Replace(PGO_PROFILE_DIR=pgo_dir)
+    if PGO_MODE == "generate":
+        # the dump runtime itself must not be instrumented
+        pgo_runtime_env = env.Clone()
+        env.Append(
+            CCFLAGS=[
+                "-fprofile-generate=%s" % pgo_dir,
+                "-fprofile-update=single",
+                "-fprofile-info-section=teensy_gcov_info"
+            ],
+            CPPPATH=[join(platform.get_dir(), "misc", "pgo")],
+            LINKFLAGS=["-fprofile-generate=%s" % pgo_dir]
+        )
+    elif PGO_MODE == "use":
+        if not isdir(pgo_dir):
+            sys.stderr.write(
+                "Error: Missing profile data in %s, please build with "
+                "`board_build.arduino.pgo = generate` and run "
+                "`pio run -t pgocollect` first\n" % pgo_dir)
+            env.Exit(1)
+        env.Append(
+            CCFLAGS=["-fprofile-use=%s" % pgo_dir, "-Wno-missing-profile"],
+            LINKFLAGS=["-fprofile-use=%s" % pgo_dir]
+        )
+    else:
+        sys.stderr.write("Error: Unknown PGO mode `%s`\n" % PGO_MODE)
+        env.Exit(1)
+
 #
 # Target: Build Core Library
 #
 
 libs = []
 
+
+def build_framework_library(variant_dir, src_dir, src_filter=None):
+    if env.IsEnabled(env.BoardConfig().get("build.arduino.core_cache", "no")):
+        return env.BuildCachedLibrary(
+            variant_dir, src_dir, src_filter, key_parts=[FRAMEWORK_VERSION])
+    return env.BuildLibrary(variant_dir, src_dir, src_filter)
+
+
 if "build.variant" in env.BoardConfig():
     env.Append(
         CPPPATH=[
@@ -361,15 +477,92 @@ if "build.variant" in env.BoardConfig():
                  env.BoardConfig().get("build.variant"))
         ]
     )
-    libs.append(env.BuildLibrary(
+    libs.append(build_framework_library(
         join("$BUILD_DIR", "FrameworkArduinoVariant"),
         join(FRAMEWORK_DIR, "variants", env.BoardConfig().get("build.variant"))
     ))
 
-libs.append(env.BuildLibrary(
+libs.append(build_framework_library(
     join("$BUILD_DIR", "FrameworkArduino"),
-    join(FRAMEWORK_DIR, "cores", BUILD_CORE),
+    CORE_DIR,
     src_filter="+<*> -<Blink.cc>"
 ))
 
+if pgo_runtime_env:
+    libs.append(pgo_runtime_env.BuildLibrary(
+        join("$BUILD_DIR", "TeensyPGO"),
+        join(platform.get_dir(), "misc", "pgo")
+    ))
+
 env.Prepend(LIBS=libs)
+
+#
+# Precompiled core header
+#
+
+
+def _pch_is_current(gch_path, dep_path):
+    if not isfile(gch_path) or not isfile(dep_path):
+        return False
+    with open(dep_path) as fp:
+        deps = [
+            dep.replace("\0", " ") for dep in fp.read().replace(
+                "\\\n", " ").replace("\\ ", "\0").split(": ", 1)[-1].split()]
+    gch_mtime = os.path.getmtime(gch_path)
+    return all(
+        isfile(dep) and os.path.getmtime(dep) <= gch_mtime for dep in deps)
+
+
+def build_precompiled_header(header):
+    pch_env = env.Clone()
+    # the sources are compiled with the debug flags PlatformIO applies
+    # after this script
+    if "debug" in env.GetBuildType():
+        pch_env.ConfigureDebugTarget()
+    pch_env.ProcessUnFlags(pch_env.get("BUILD_UNFLAGS"))
+    command = pch_env.subst(
+        "$CXX -x c++-header -c $CXXFLAGS $CCFLAGS $_CCCOMCOM")
+    key = hashlib.sha1(" ".join(
+        [FRAMEWORK_VERSION, pch_env.subst("$BOARD"), command]).encode()
+    ).hexdigest()[:16]
+    pch_root = join(env.subst("$BUILD_DIR"), "pch")
+    pch_dir = join(pch_root, key)
+    gch_path = join(pch_dir, header + ".gch")
+    dep_path = join(pch_dir, header + ".d")
+    if _pch_is_current(gch_path, dep_path):
+        return pch_dir
+
+    # flags have changed, drop headers precompiled for other flags
+    if isdir(pch_root):
+        for name in os.listdir(pch_root):
+            if name != key:
+                shutil.rmtree(join(pch_root, name), ignore_errors=True)
+    if not isdir(pch_dir):
+        os.makedirs(pch_dir)
+    result = env.Execute(env.VerboseAction(
+        '%s -MD -MF "%s" -o "%s" "%s"' % (
+            command, dep_path, gch_path, join(CORE_DIR, header)),
+        "Precompiling %s" % header))
+    if result:
+        sys.stderr.write(
+            "Warning! Could not precompile %s, continuing without it\n" %
+            header)
+        shutil.rmtree(pch_dir, ignore_errors=True)
+        return None
+    return pch_dir
+
+
+# GCC uses "<dir>/Arduino.h.gch" instead of "Arduino.h" when the directory
+# is searched first and the header is the first thing a C++ file includes.
+# A precompiled header built with other flags is silently ignored.
+PCH_HEADER = env.BoardConfig().get("build.arduino.pch_header", "Arduino.h")
+if env.IsEnabled(env.BoardConfig().get("build.arduino.pch", "no")) and isfile(
+            join(CORE_DIR, PCH_HEADER)) and not env.GetOption("clean") and not (
+                set(COMMAND_LINE_TARGETS) & set(["idedata", "__idedata"])):
+    if env.get("CCACHE"):
+        # https://ccache.dev/manual/latest.html#_precompiled_headers
+        env["ENV"]["CCACHE_SLOPPINESS"] = "pch_defines,time_macros"
+        env.Append(CXXFLAGS=["-fpch-preprocess"])
+    pch_dir = build_precompiled_header(PCH_HEADER)
+    if pch_dir:
+        env.Prepend(CPPPATH=[pch_dir])
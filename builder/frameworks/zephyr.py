@@ -18,12 +18,169 @@ safety and security in mind.
 https://github.com/zephyrproject-rtos/zephyr
 """
 
-from os.path import join
+import hashlib
+import json
+import os
+import time
+from os.path import isfile, join, relpath
 
 from SCons.Script import Import, SConscript
 
 Import("env")
 
+platform = env.PioPlatform()
+board = env.BoardConfig()
+
+BUILD_DIR = env.subst("$BUILD_DIR")
+CMAKE_CACHE = join(BUILD_DIR, "CMakeCache.txt")
+CONFIGURE_STAMP = join(BUILD_DIR, "zephyr-configure.json")
+
+# project options which never reach the CMake configure step
+CONFIGURE_IGNORED_OPTIONS = (
+    "check_", "custom_", "debug_", "monitor_", "test_", "upload_")
+
+
+def _hash_tree(h, path, with_content=True):
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = join(root, name)
+            h.update(relpath(file_path, path).replace("\\", "/").encode())
+            if with_content:
+                with open(file_path, "rb") as fp:
+                    h.update(hashlib.sha1(fp.read()).digest())
+
+
+def get_configure_fingerprint():
+    """
+    Hash of everything the CMake, Kconfig and devicetree configure step
+    reads: the "zephyr" folder of the project (CMakeLists.txt, prj.conf,
+    overlays), the names of the sources it may glob, the board, the
+    package versions and the build options of the environment
+    """
+    h = hashlib.sha1()
+    options = {
+        name: value for name, value in env.GetProjectConfig().items(
+            env=env["PIOENV"], as_dict=True).items()
+        if not name.startswith(CONFIGURE_IGNORED_OPTIONS)}
+    h.update(json.dumps([
+        board.id,
+        board.get("build", {}),
+        options,
+        [(name, str(platform.get_package_version(name)))
+         for name in ("framework-zephyr", "tool-cmake", "tool-dtc",
+                      "tool-ninja", "toolchain-gccarmnoneeabi")
+         if name in platform.packages],
+    ], sort_keys=True, default=str).encode())
+    _hash_tree(h, join(env.subst("$PROJECT_DIR"), "zephyr"))
+    _hash_tree(h, env.subst("$PROJECT_SRC_DIR"), with_content=False)
+    return h.hexdigest()
+
+
+def _read_configure_stamp():
+    try:
+        with open(CONFIGURE_STAMP) as fp:
+            return json.load(fp).get("fingerprint")
+    except (IOError, ValueError):
+        return None
+
+
+configure_cache = env.IsEnabled(
+    board.get("build.zephyr.configure_cache", "no"))
+if configure_cache and isfile(CMAKE_CACHE):
+    configure_fingerprint = get_configure_fingerprint()
+    if _read_configure_stamp() == configure_fingerprint:
+        # the inputs only got newer timestamps (a checkout, a restored CI
+        # cache, an unrelated option of "platformio.ini"), mark the CMake
+        # cache as current so the build script doesn't reconfigure. The
+        # dependencies of Ninja itself are left alone.
+        now = time.time()
+        os.utime(CMAKE_CACHE, (now, now))
+    else:
+        # make sure the build script reconfigures, even for changes it
+        # doesn't track, like a new framework version
+        os.utime(CMAKE_CACHE, (0, 0))
+
+
+#
+# Shared cache of prebuilt Zephyr libraries
+#
+
+FRAMEWORK_DIR = platform.get_package_dir("framework-zephyr")
+PROJECT_DIR = env.subst("$PROJECT_DIR")
+
+
+def _hash_file(path):
+    if not isfile(path):
+        return None
+    with open(path, "rb") as fp:
+        return hashlib.sha1(fp.read()).hexdigest()
+
+
+def _is_app_source(path):
+    return path.startswith(join(PROJECT_DIR, "")) and not path.startswith(
+        join(BUILD_DIR, ""))
+
+
+def _source_name(path):
+    for base in (FRAMEWORK_DIR, BUILD_DIR):
+        if path.startswith(join(base, "")):
+            return relpath(path, base).replace("\\", "/")
+    return path
+
+
+def _object_flags(source):
+    # the build script compiles every library with its own flags and
+    # defines, the paths of the project must not split the cache
+    flags = set()
+    for obj in env.Flatten([source]):
+        build_env = obj.get_build_env()
+        flags.add(build_env.subst(
+            "$CCFLAGS $CFLAGS $CXXFLAGS $ASFLAGS $_CPPDEFFLAGS "
+            "$_CPPINCFLAGS").replace(
+                BUILD_DIR, "<build>").replace(PROJECT_DIR, "<project>"))
+    return sorted(flags)
+
+
+def CachedLibrary(env, target=None, source=None, *args, **kwargs):
+    """
+    Replacement of `env.Library` for the libraries of the Zephyr build,
+    which links the prebuilt kernel and driver libraries of any application
+    with the same board, resolved Kconfig and devicetree
+    """
+    config_hash = _hash_file(join(BUILD_DIR, "zephyr", ".config"))
+    dts_hash = _hash_file(join(BUILD_DIR, "zephyr", "zephyr.dts"))
+    sources = sorted(
+        src.srcnode().get_abspath()
+        for obj in env.Flatten([source]) for src in obj.sources)
+    if args or kwargs or not (config_hash and dts_hash) or any(
+            _is_app_source(path) for path in sources):
+        return env.StaticLibrary(target, source, *args, **kwargs)
+    return env.BuildCachedArchive(target, source, [
+        board.id, config_hash, dts_hash,
+        platform.get_package_version("framework-zephyr"),
+        env.subst("$BUILD_FLAGS $BUILD_UNFLAGS"),
+        [_source_name(path) for path in sources],
+        _object_flags(source),
+    ], dict(core="zephyr"))
+
+
+if env.IsEnabled(board.get("build.zephyr.libcache", "no")):
+    env.AddMethod(CachedLibrary, "Library")
+
 SConscript(
-    join(env.PioPlatform().get_package_dir("framework-zephyr"), "scripts",
-         "platformio", "platformio-build.py"), exports="env")
\ No newline at end of file
+    join(platform.get_package_dir("framework-zephyr"), "scripts",
+         "platformio", "platformio-build.py"), exports="env")
+
+if configure_cache and isfile(CMAKE_CACHE):
+    configure_fingerprint = get_configure_fingerprint()
+
+    def _write_configure_stamp(target, source, env):
+        # only a build that got through the configure step and the link
+        # vouches for the configuration
+        with open(CONFIGURE_STAMP, "w") as fp:
+            json.dump(dict(fingerprint=configure_fingerprint), fp)
+
+    # the program node doesn't exist yet, "main.py" attaches the action
+    env.Append(PROGRAM_POSTACTIONS=[
+        env.VerboseAction(_write_configure_stamp, "")])
@@ -0,0 +1,187 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Profile-driven placement of functions into the i.MX RT ITCM.
+
+A histogram of sampled program counters is mapped onto the functions of
+the profiled firmware, which keeps the profile valid after the layout
+changes. The hottest functions (by samples per byte) are then kept in ITCM
+within a budget and all other profiled functions are moved to flash, by a
+copy of the Teensy 4 linker script with explicit input section lists.
+
+Only functions compiled into their own ".text.*" section can be moved,
+FASTRUN and FLASHMEM functions keep their place.
+"""
+
+import bisect
+import hashlib
+import json
+import re
+import struct
+from os.path import basename, join, splitext
+
+from elf import SHF_EXECINSTR, STT_FUNC, ElfFile
+
+PROFILE_VERSION = 1
+
+# GCC prefixes of function sections, e.g. ".text.unlikely.foo"
+TEXT_PREFIXES = ("", "hot.", "unlikely.", "startup.")
+SECTION_NAME_RE = re.compile(r"^[\w.$]+$")
+ITCM_INPUT_RE = re.compile(r"^([ \t]*)\*\(\.fastrun\)[ \t]*$", re.M)
+FLASH_INPUT_RE = re.compile(r"^([ \t]*)\*\(\.flashmem\*\)[ \t]*$", re.M)
+
+
+class HotPlaceError(Exception):
+    pass
+
+
+def read_histogram(path):
+    """
+    Return {pc: samples}. Text files hold one "<hex pc> [count]" per line,
+    binary files (".bin" or any NUL byte) a little endian 32-bit PC per
+    sample, as streamed by DWT PC sampling.
+    """
+    with open(path, "rb") as fp:
+        data = fp.read()
+    histogram = {}
+    if path.endswith(".bin") or b"\0" in data:
+        for (pc,) in struct.iter_unpack("<I", data[:len(data) & ~3]):
+            histogram[pc] = histogram.get(pc, 0) + 1
+        return histogram
+    for number, line in enumerate(data.decode("latin-1").splitlines(), 1):
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        items = line.replace(",", " ").replace(":", " ").split()
+        try:
+            pc = int(items[0], 16)
+            count = int(items[1]) if len(items) > 1 else 1
+        except ValueError:
+            raise HotPlaceError("%s:%d: invalid sample `%s`" % (
+                path, number, line))
+        histogram[pc] = histogram.get(pc, 0) + count
+    return histogram
+
+
+def map_histogram(elf_path, histogram):
+    """Map a PC histogram onto the code functions of the profiled ELF"""
+    with ElfFile(elf_path) as elf:
+        code = [s for s in elf.sections if s.flags & SHF_EXECINSTR and s.size]
+        functions = {}
+        for symbol in elf.symbols():
+            if symbol.type != STT_FUNC or not symbol.size:
+                continue
+            address = symbol.value & ~1
+            section = next((s.name for s in code if (
+                s.addr <= address < s.addr + s.size)), None)
+            if section and symbol.name not in functions:
+                functions[symbol.name] = (address, symbol.size, section)
+    ordered = sorted(functions.items(), key=lambda item: item[1][0])
+    starts = [item[1][0] for item in ordered]
+    samples = {}
+    unmapped = 0
+    for pc, count in histogram.items():
+        pos = bisect.bisect_right(starts, pc & ~1) - 1
+        if pos >= 0 and pc & ~1 < starts[pos] + ordered[pos][1][1]:
+            name = ordered[pos][0]
+            samples[name] = samples.get(name, 0) + count
+        else:
+            unmapped += count
+    return dict(
+        version=PROFILE_VERSION,
+        elf=elf_path,
+        samples=sum(histogram.values()),
+        unmapped=unmapped,
+        functions={
+            name: dict(
+                size=size, section=section, samples=samples.get(name, 0))
+            for name, (_, size, section) in ordered})
+
+
+def load_profile(path):
+    with open(path) as fp:
+        profile = json.load(fp)
+    if profile.get("version") != PROFILE_VERSION:
+        raise HotPlaceError("%s: unsupported profile version" % path)
+    return profile
+
+
+def select(profile, budget):
+    """
+    Return (hot, cold) function names. Sampled functions are taken by
+    samples per byte until `budget` bytes of ITCM are used.
+    """
+    candidates = sorted(
+        ((name, item) for name, item in profile["functions"].items()
+         if item["samples"] and SECTION_NAME_RE.match(name)),
+        key=lambda c: (-float(c[1]["samples"]) / c[1]["size"], c[0]))
+    hot = []
+    used = 0
+    for name, item in candidates:
+        size = (item["size"] + 3) & ~3
+        if used + size <= budget:
+            hot.append(name)
+            used += size
+    selected = set(hot)
+    cold = sorted(
+        name for name in profile["functions"]
+        if name not in selected and SECTION_NAME_RE.match(name))
+    return hot, cold
+
+
+def _input_sections(names, indent):
+    return "".join(
+        "%s*(%s)\n" % (indent, " ".join(
+            ".text.%s%s" % (prefix, name) for prefix in TEXT_PREFIXES))
+        for name in names)
+
+
+def generate_ldscript(source, hot, cold):
+    """
+    Return the text of linker script `source` with the `hot` functions
+    listed first in ITCM and the `cold` ones placed in flash. The flash
+    code section comes first in the script, so its explicit lists take
+    precedence over the "*(.text*)" of the ITCM section.
+    """
+    with open(source) as fp:
+        text = fp.read()
+    for regex, pattern, names in (
+            (ITCM_INPUT_RE, "*(.fastrun)", hot),
+            (FLASH_INPUT_RE, "*(.flashmem*)", cold)):
+        match = regex.search(text)
+        if not match:
+            raise HotPlaceError(
+                "%s: no `%s` input section to extend" % (source, pattern))
+        if names:
+            text = "%s\n%s%s" % (
+                text[:match.end()],
+                _input_sections(names, match.group(1)).rstrip("\n"),
+                text[match.end():])
+    return text
+
+
+def write_ldscript(source, dest_dir, hot, cold):
+    """
+    Write the generated script, named after its content, so a new
+    placement changes the link command and relinks the firmware
+    """
+    text = generate_ldscript(source, hot, cold)
+    name = "%s.%s.ld" % (
+        splitext(basename(source))[0],
+        hashlib.sha1(text.encode()).hexdigest()[:10])
+    path = join(dest_dir, name)
+    with open(path, "w") as fp:
+        fp.write(text)
+    return path
@@ -0,0 +1,115 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Incremental J-Link flashing: compare a new Intel HEX image against the
+image flashed last time and program only the flash sectors that differ.
+"""
+
+import os
+from os.path import isdir, join
+
+ERASED_BYTE = 0xFF
+
+
+def read_ihex(path):
+    """Return the data records of an Intel HEX file as (address, data)"""
+    chunks = []
+    base = 0
+    with open(path) as fp:
+        for line in fp:
+            line = line.strip()
+            if not line.startswith(":"):
+                continue
+            record = bytes.fromhex(line[1:])
+            count, address, rec_type = (
+                record[0], (record[1] << 8) | record[2], record[3])
+            data = record[4:4 + count]
+            if rec_type == 0:
+                start = base + address
+                if chunks and chunks[-1][0] + len(chunks[-1][1]) == start:
+                    chunks[-1][1].extend(data)
+                else:
+                    chunks.append((start, bytearray(data)))
+            elif rec_type == 2:
+                base = ((data[0] << 8) | data[1]) << 4
+            elif rec_type == 4:
+                base = ((data[0] << 8) | data[1]) << 16
+            elif rec_type == 1:
+                break
+    return chunks
+
+
+def _sectors(chunks, sector_size):
+    result = {}
+    for address, data in chunks:
+        pos = 0
+        while pos < len(data):
+            where = address + pos
+            sector = where - where % sector_size
+            offset = where - sector
+            size = min(sector_size - offset, len(data) - pos)
+            if sector not in result:
+                result[sector] = bytearray([ERASED_BYTE] * sector_size)
+            result[sector][offset:offset + size] = data[pos:pos + size]
+            pos += size
+    return result
+
+
+def plan(old_chunks, new_chunks, sector_size):
+    """
+    Return (program, erase) lists of (start, data)/(start, end) ranges.
+    Adjacent changed sectors are merged into a single range.
+    """
+    old_sectors = _sectors(old_chunks, sector_size)
+    new_sectors = _sectors(new_chunks, sector_size)
+
+    program = []
+    for sector in sorted(new_sectors):
+        if old_sectors.get(sector) == new_sectors[sector]:
+            continue
+        if program and program[-1][0] + len(program[-1][1]) == sector:
+            program[-1][1].extend(new_sectors[sector])
+        else:
+            program.append((sector, bytearray(new_sectors[sector])))
+
+    erase = []
+    for sector in sorted(set(old_sectors) - set(new_sectors)):
+        if erase and erase[-1][1] == sector:
+            erase[-1] = (erase[-1][0], sector + sector_size)
+        else:
+            erase.append((sector, sector + sector_size))
+    return [(s, bytes(d)) for s, d in program], erase
+
+
+def commands(program, erase, work_dir, verify=False):
+    """Write the data chunks to `work_dir` and return J-Link commands"""
+    if not isdir(work_dir):
+        os.makedirs(work_dir)
+    for name in os.listdir(work_dir):
+        if name.startswith("sector_") and name.endswith(".bin"):
+            os.remove(join(work_dir, name))
+
+    result = ["h"]
+    for start, end in erase:
+        result.append("erase 0x%08X 0x%08X" % (start, end))
+    for start, data in program:
+        path = join(work_dir, "sector_%08X.bin" % start)
+        with open(path, "wb") as fp:
+            fp.write(data)
+        result.append("loadbin %s, 0x%08X" % (path, start))
+        if verify:
+            result.append("verifybin %s, 0x%08X" % (path, start))
+    result.extend(["r", "q"])
+    return result
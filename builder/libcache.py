@@ -0,0 +1,132 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Machine-wide, content-addressed cache for prebuilt static libraries.
+
+Every entry lives in its own directory named after the cache key and holds
+the archive plus a small "meta.json" with the inputs the key was built from.
+The modification time of the entry directory is bumped on every hit, so
+eviction simply removes the least recently used entries first.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from os.path import getsize, isdir, isfile, join
+
+META_FILE = "meta.json"
+
+
+def make_key(*parts):
+    h = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, (list, tuple)):
+            part = " ".join(str(p) for p in part)
+        h.update(str(part).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def _dir_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += getsize(join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+class LibraryCache(object):
+
+    def __init__(self, root, max_size=0, max_age=0):
+        self.root = root
+        self.max_size = max_size
+        self.max_age = max_age
+
+    def entry_dir(self, key):
+        return join(self.root, key)
+
+    def lookup(self, key, name):
+        path = join(self.entry_dir(key), name)
+        if not isfile(path):
+            return None
+        try:
+            os.utime(self.entry_dir(key), None)
+        except OSError:
+            pass
+        return path
+
+    def store(self, key, src_path, meta=None):
+        entry_dir = self.entry_dir(key)
+        if not isdir(entry_dir):
+            os.makedirs(entry_dir)
+        name = os.path.basename(src_path)
+        # copy to a temporary file first so that concurrent builds never
+        # link a half-written archive
+        tmp_path = join(entry_dir, "%s.%d.tmp" % (name, os.getpid()))
+        shutil.copyfile(src_path, tmp_path)
+        os.replace(tmp_path, join(entry_dir, name))
+        meta = dict(meta or {})
+        meta.update(name=name, created=int(time.time()))
+        with open(join(entry_dir, META_FILE), "w") as fp:
+            json.dump(meta, fp, indent=2, sort_keys=True)
+        if self.max_size or self.max_age:
+            self.prune()
+        return join(entry_dir, name)
+
+    def entries(self):
+        result = []
+        if not isdir(self.root):
+            return result
+        for key in os.listdir(self.root):
+            entry_dir = join(self.root, key)
+            if not isdir(entry_dir):
+                continue
+            meta = {}
+            if isfile(join(entry_dir, META_FILE)):
+                try:
+                    with open(join(entry_dir, META_FILE)) as fp:
+                        meta = json.load(fp)
+                except ValueError:
+                    pass
+            result.append(dict(
+                key=key,
+                path=entry_dir,
+                size=_dir_size(entry_dir),
+                last_used=os.path.getmtime(entry_dir),
+                meta=meta
+            ))
+        return sorted(result, key=lambda item: item["last_used"], reverse=True)
+
+    def prune(self, max_size=None, max_age=None):
+        """
+        Remove the least recently used entries above `max_size` bytes and
+        the entries not used for `max_age` seconds (0 keeps them)
+        """
+        max_size = self.max_size if max_size is None else max_size
+        max_age = self.max_age if max_age is None else max_age
+        removed = []
+        total = 0
+        for entry in self.entries():
+            total += entry["size"]
+            if (max_size and total > max_size) or (
+                    max_age and entry["last_used"] < time.time() - max_age):
+                shutil.rmtree(entry["path"], ignore_errors=True)
+                removed.append(entry)
+        return removed
@@ -12,16 +12,39 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import atexit
+import os
+import re
+import subprocess
 import sys
+import time
 from platform import system
 from os import makedirs, environ
-from os.path import isdir, isfile, join
+from os.path import basename, dirname, isdir, isfile, join
+from shutil import copyfile, rmtree
 
-from SCons.Script import (COMMAND_LINE_TARGETS, AlwaysBuild, Builder, Default,
-                          DefaultEnvironment)
+from SCons.Script import (ARGUMENTS, COMMAND_LINE_TARGETS, AlwaysBuild,
+                          Builder, Default, DefaultEnvironment)
 
 from platformio.proc import exec_command
 
+import boolopt
+import buildtimer
+import elf
+import fleet
+import hotplace
+import jlinkdiff
+import matrix
+import memregions
+import pgo
+import placement
+import regplan
+import sizecheck
+import stackusage
+import svdindex
+from libcache import LibraryCache, make_key
+from uploadstate import UploadState, image_hash
+
 env = DefaultEnvironment()
 platform = env.PioPlatform()
 board_config = env.BoardConfig()
@@ -36,6 +59,36 @@ env.Replace(
 )
 
 build_core = board_config.get("build.core", "")
+
+
+def IsEnabled(env, value):
+    return boolopt.is_enabled(value)
+
+
+env.AddMethod(IsEnabled)
+
+
+# Thin archives only reference the object files in the build directory
+if env.IsEnabled(board_config.get("build.thin_archives", "no")):
+    env.Replace(ARFLAGS=["rcT"])
+
+
+def _objcopy_action(flags):
+    if env.IsEnabled(board_config.get("build.native_objcopy", "no")):
+        try:
+            options = elf.parse_objcopy_flags(flags)
+        except ValueError as exc:
+            sys.stderr.write("Error: Native objcopy: %s\n" % exc)
+            env.Exit(1)
+
+        def _convert(target, source, env):
+            elf.convert(source[0].get_abspath(),
+                        [(target[0].get_abspath(), options)])
+        return env.VerboseAction(_convert, "Building $TARGET")
+    return env.VerboseAction(
+        " ".join(["$OBJCOPY"] + flags + ["$SOURCES", "$TARGET"]),
+        "Building $TARGET")
+
 if "BOARD" in env and build_core == "teensy":
     env.Replace(
         AR="avr-ar",
@@ -52,8 +105,7 @@ if "BOARD" in env and build_core == "teensy":
     env.Append(
         BUILDERS=dict(
             ElfToEep=Builder(
-                action=env.VerboseAction(" ".join([
-                    "$OBJCOPY",
+                action=_objcopy_action([
                     "-O",
                     "ihex",
                     "-j",
@@ -61,23 +113,18 @@ if "BOARD" in env and build_core == "teensy":
                     '--set-section-flags=.eeprom="alloc,load"',
                     "--no-change-warnings",
                     "--change-section-lma",
-                    ".eeprom=0",
-                    "$SOURCES",
-                    "$TARGET"
-                ]), "Building $TARGET"),
+                    ".eeprom=0"
+                ]),
                 suffix=".eep"
             ),
 
             ElfToHex=Builder(
-                action=env.VerboseAction(" ".join([
-                    "$OBJCOPY",
+                action=_objcopy_action([
                     "-O",
                     "ihex",
                     "-R",
-                    ".eeprom",
-                    "$SOURCES",
-                    "$TARGET"
-                ]), "Building $TARGET"),
+                    ".eeprom"
+                ]),
                 suffix=".hex"
             )
         )
@@ -102,26 +149,20 @@ elif "BOARD" in env and build_core in ("teensy3", "teensy4"):
     env.Append(
         BUILDERS=dict(
             ElfToBin=Builder(
-                action=env.VerboseAction(" ".join([
-                    "$OBJCOPY",
+                action=_objcopy_action([
                     "-O",
-                    "binary",
-                    "$SOURCES",
-                    "$TARGET"
-                ]), "Building $TARGET"),
+                    "binary"
+                ]),
                 suffix=".bin"
             ),
 
             ElfToHex=Builder(
-                action=env.VerboseAction(" ".join([
-                    "$OBJCOPY",
+                action=_objcopy_action([
                     "-O",
                     "ihex",
                     "-R",
-                    ".eeprom",
-                    "$SOURCES",
-                    "$TARGET"
-                ]), "Building $TARGET"),
+                    ".eeprom"
+                ]),
                 suffix=".hex"
             )
         )
@@ -137,24 +178,818 @@ env.Replace(
     SIZEDATAREGEXP=r"^(?:\.usbdescriptortable|\.dmabuffers|\.usbbuffers|\.data|\.bss|\.noinit|\.text\.itcm|\.text\.itcm\.padding)\s+([0-9]+).*",
 )
 
-# Disable memory calculation and print output from custom "teensy_size" tool
-if "arduino" in env.subst("$PIOFRAMEWORK") and build_core == "teensy4":
-    def teensy_check_upload_size(_, target, source, env):
-        print('Advanced Memory Usage is available via "PlatformIO Home > Project Inspect"')
-        sysenv = environ.copy()
-        sysenv["PATH"] = str(env["ENV"]["PATH"])
-        result = exec_command(["teensy_size", str(source[0])], env=sysenv)
-        if result["returncode"] != 0:
-            sys.stderr.write(result["err"])
-            env.Exit(1)
+#
+# Worst-case stack depth
+#
+
+stack_usage_enabled = env.IsEnabled(board_config.get("build.stack_usage", "no"))
+
+
+def _get_gcc_major():
+    if build_core == "teensy":
+        name = "toolchain-atmelavr"
+    elif "arduino" in env.get("PIOFRAMEWORK", []):
+        name = "toolchain-gccarmnoneeabi-teensy"
+    else:
+        name = "toolchain-gccarmnoneeabi"
+    # package versions encode the GCC version, e.g. 1.150201.0 is 15.2.1
+    version = str(platform.get_package_version(name) or "")
+    return int(version.split(".")[1][:-4]) if version.count(".") > 1 else 0
+
+
+def _demangle(names):
+    sysenv = environ.copy()
+    sysenv["PATH"] = str(env["ENV"]["PATH"])
+    result = subprocess.run(
+        [env.subst("$CC").replace("gcc", "c++filt")],
+        input="\n".join(names), stdout=subprocess.PIPE,
+        universal_newlines=True, env=sysenv)
+    demangled = result.stdout.splitlines()
+    return demangled if len(demangled) == len(names) else names
+
+
+def _check_stack_usage(elf_path, data_size, data_max_size):
+    build_dir = env.subst("$BUILD_DIR")
+    ci_files = list(stackusage.find_files(build_dir, ".ci"))
+    if ci_files:
+        graph = stackusage.parse_callgraph_info(ci_files)
+    else:
+        with elf.ElfFile(elf_path) as elf_file:
+            names = sorted(set(
+                s.name for s in elf_file.symbols() if s.type == elf.STT_FUNC))
+        graph = stackusage.elf_call_graph(
+            elf_path, stackusage.match_stack_usage(stackusage.parse_stack_usage(
+                stackusage.find_files(build_dir, ".su")), names, _demangle))
 
-    env.AddMethod(teensy_check_upload_size, "CheckUploadSize")
+    if build_core == "teensy":
+        exception_frame = 2  # return address
+    elif "-mfloat-abi=hard" in env.get("CCFLAGS", []):
+        exception_frame = 104  # basic frame and the lazily stacked FPU state
+    else:
+        exception_frame = 32
+    report = stackusage.analyze(
+        graph, elf_path, exception_frame,
+        int(board_config.get("build.stack_usage_isr_nesting", 1)))
+    sizecheck.write_report(
+        env.subst(join("$BUILD_DIR", "${PROGNAME}.stack.json")), report)
+
+    # the reset path and the deepest interrupt handler
+    shown = [e for e in report["entries"] if e["kind"] == "reset"] + sorted(
+        (e for e in report["entries"] if e["kind"] == "isr"),
+        key=lambda e: e["depth"], reverse=True)[:1]
+    for entry in shown:
+        print("Stack: %-6d bytes %s" % (
+            entry["depth"], " > ".join(entry["path"][:8])))
+        for note in entry["notes"]:
+            print("       (%s)" % note)
+    print("Stack: worst case %d bytes, see %s.stack.json" % (
+        report["worst_case"], env.subst("$PROGNAME")))
+    if data_max_size and data_size + report["worst_case"] > data_max_size:
+        sys.stderr.write(
+            "Error: Static data (%d bytes) and the worst-case stack (%d bytes) "
+            "exceed the available RAM (%s bytes)\n" % (
+                data_size, report["worst_case"], data_max_size))
+        env.Exit(1)
+
+
+if stack_usage_enabled:
+    env.Append(CCFLAGS=["-fstack-usage"])
+    if _get_gcc_major() >= 10:
+        # with LTO the frames are known after the link-time compilation
+        env.Append(
+            CCFLAGS=["-fcallgraph-info=su"],
+            LINKFLAGS=["-fstack-usage", "-fcallgraph-info=su",
+                       "-dumpdir", join("$BUILD_DIR", "")])
+
+
+def _check_memory_regions(elf_path):
+    regions = memregions.load_regions(
+        board_config.get("upload.memory_regions"))
+    report = memregions.account(
+        elf_path, regions, board_config.get("upload.memory_pools", {}))
+    sizecheck.write_report(
+        env.subst(join("$BUILD_DIR", "${PROGNAME}.regions.json")), report)
+
+    for name, item in sorted(report["pools"].items()):
+        print("%-7s%s" % (name + ":", sizecheck.format_usage(
+            item["used"], item["length"])))
+    for region in regions:
+        item = report["regions"][region.name]
+        if region.optional and not item["allocated"]:
+            continue
+        print("  %-7s%s" % (region.name + ":", sizecheck.format_usage(
+            item["allocated"], region.length)))
+        if region.bank_size and item["allocated"] >= region.bank_size:
+            print("         %d bytes of code in %d banks, moving %d bytes to "
+                  "flash frees %d bytes (`pio run -t memadvisor`)" % (
+                      item["used"], item["allocated"] // region.bank_size,
+                      item["used"] - item["allocated"] + region.bank_size,
+                      region.bank_size))
+    errors = memregions.check(report, regions)
+    if errors:
+        sys.stderr.write(
+            "Error: Memory regions are over their budget: %s\n" %
+            ", ".join(errors))
+        env.Exit(1)
+
+
+def _write_size_report(elf_path, env):
+    # read by the matrix targets, every build reports with its own regexps
+    report = sizecheck.calculate(
+        elf_path, env.get("SIZEPROGREGEXP"), env.get("SIZEDATAREGEXP"))
+    report.update(
+        maximum_size=int(board_config.get("upload.maximum_size", 0)),
+        maximum_ram_size=int(board_config.get("upload.maximum_ram_size", 0)))
+    sizecheck.write_report(
+        env.subst(join("$BUILD_DIR", "${PROGNAME}.size.json")), report)
+    return report
+
+
+def native_check_upload_size(_, target, source, env):
+    report = _write_size_report(source[0].get_abspath(), env)
+    program_max_size = report["maximum_size"]
+    data_max_size = report["maximum_ram_size"]
+
+    print('Advanced Memory Usage is available via "PlatformIO Home > Project Inspect"')
+    if data_max_size:
+        print("RAM:   %s" % sizecheck.format_usage(
+            report["data"], data_max_size))
+    if program_max_size:
+        print("Flash: %s" % sizecheck.format_usage(
+            report["program"], program_max_size))
+    if data_max_size and report["data"] > data_max_size:
+        sys.stderr.write(
+            "Warning! The data size (%d bytes) is greater "
+            "than maximum allowed (%s bytes)\n" % (
+                report["data"], data_max_size))
+    if program_max_size and report["program"] > program_max_size:
+        sys.stderr.write(
+            "Error: The program size (%d bytes) is greater "
+            "than maximum allowed (%s bytes)\n" % (
+                report["program"], program_max_size))
+        env.Exit(1)
+    if board_config.get("upload.memory_regions", None):
+        _check_memory_regions(source[0].get_abspath())
+    if stack_usage_enabled:
+        _check_stack_usage(
+            source[0].get_abspath(), report["data"], data_max_size)
+
+
+# Print output from custom "teensy_size" tool
+if "arduino" in env.subst("$PIOFRAMEWORK") and build_core == "teensy4":
     env.Replace(
         SIZETOOL=None,
         SIZECHECKCMD=None,
         SIZEPRINTCMD="teensy_size $SOURCES",
     )
 
+# the native check is opt-in until its figures are confirmed against the
+# size tools for every board
+if board_config.get("build.size_check", "toolchain") == "toolchain":
+    # Disable memory calculation and print output from "teensy_size" tool
+    if "arduino" in env.subst("$PIOFRAMEWORK") and build_core == "teensy4":
+        def teensy_check_upload_size(_, target, source, env):
+            print('Advanced Memory Usage is available via "PlatformIO Home > Project Inspect"')
+            sysenv = environ.copy()
+            sysenv["PATH"] = str(env["ENV"]["PATH"])
+            result = exec_command(["teensy_size", str(source[0])], env=sysenv)
+            if result["returncode"] != 0:
+                sys.stderr.write(result["err"])
+                env.Exit(1)
+            report = _write_size_report(source[0].get_abspath(), env)
+            if board_config.get("upload.memory_regions", None):
+                _check_memory_regions(source[0].get_abspath())
+            if stack_usage_enabled:
+                _check_stack_usage(
+                    source[0].get_abspath(), report["data"],
+                    report["maximum_ram_size"])
+
+        env.AddMethod(teensy_check_upload_size, "CheckUploadSize")
+    else:
+        default_check_upload_size = env.CheckUploadSize
+
+        def toolchain_check_upload_size(_, target, source, env):
+            result = default_check_upload_size(target, source, env)
+            report = _write_size_report(source[0].get_abspath(), env)
+            if stack_usage_enabled:
+                _check_stack_usage(
+                    source[0].get_abspath(), report["data"],
+                    report["maximum_ram_size"])
+            return result
+
+        env.AddMethod(toolchain_check_upload_size, "CheckUploadSize")
+else:
+    env.AddMethod(native_check_upload_size, "CheckUploadSize")
+
+#
+# Shared cache of prebuilt libraries
+#
+
+def _get_library_cache(env):
+    return LibraryCache(
+        join(env.GetProjectConfig().get("platformio", "cache_dir"),
+             "teensy", "libs"),
+        int(board_config.get("build.libcache_size", 1024)) * 1024 * 1024,
+        int(board_config.get("build.libcache_max_age", 0)) * 24 * 3600)
+
+
+# lookups of this run, for the report written at exit
+libcache_results = []
+
+
+def _get_toolchain_versions():
+    result = []
+    for name in ("toolchain-atmelavr", "toolchain-gccarmnoneeabi",
+                 "toolchain-gccarmnoneeabi-teensy"):
+        if name in platform.packages:
+            result.append("%s@%s" % (name, platform.get_package_version(name)))
+    return result
+
+
+def _get_final_flags(env):
+    # frameworks run before PlatformIO applies the debug flags, which the
+    # objects are compiled with later on
+    flags_env = env.Clone()
+    if "debug" in env.GetBuildType():
+        flags_env.ConfigureDebugTarget()
+        flags_env.ProcessUnFlags(flags_env.get("BUILD_UNFLAGS"))
+    return flags_env.subst(
+        "$CC $CCFLAGS $CFLAGS $CXXFLAGS $ASFLAGS $ASPPFLAGS $_CPPDEFFLAGS")
+
+
+def BuildCachedLibrary(env, variant_dir, src_dir, src_filter=None,
+                       key_parts=None):
+    env.ProcessUnFlags(env.get("BUILD_UNFLAGS"))
+    cache = _get_library_cache(env)
+    name = env.subst("${LIBPREFIX}%s${LIBSUFFIX}" % basename(variant_dir))
+    key = make_key(
+        board_config.id, build_core, name, src_filter,
+        _get_toolchain_versions(), key_parts or [], placement_rules,
+        env.GetBuildType(), _get_final_flags(env))
+
+    cached_path = cache.lookup(key, name)
+    libcache_results.append(dict(library=name, key=key, hit=bool(cached_path)))
+    if cached_path:
+        if int(ARGUMENTS.get("PIOVERBOSE", 0)):
+            print("Using cached %s (%s)" % (name, key[:10]))
+        return env.File(cached_path)
+
+    def _store(target, source, env):
+        cache.store(key, target[0].get_abspath(), dict(
+            board=board_config.id, core=build_core, library=name))
+
+    # the cache needs an archive which contains the objects. The objects
+    # are built by `env` itself, which gets the debug flags later on.
+    lib = env.StaticLibrary(
+        env.subst(variant_dir),
+        env.CollectBuildFiles(variant_dir, src_dir, src_filter),
+        ARFLAGS=["rc"])
+    env.AddPostAction(lib, env.VerboseAction(_store, "Caching $TARGET"))
+    return lib
+
+
+def _copy_cached_archive(target, source, env):
+    copyfile(source[0].get_abspath(), target[0].get_abspath())
+
+
+def BuildCachedArchive(env, target, source, key_parts, meta=None):
+    """
+    Create the archive `target` from the shared cache when it holds an
+    entry for `key_parts`, otherwise archive the `source` objects and
+    store the result. The archive keeps its place in the build directory,
+    so scripts which refer to it by path link the cached copy.
+    """
+    path = env.subst(str(target))
+    name = basename(path)
+    if not name.startswith(env.subst("$LIBPREFIX")):
+        name = env.subst("$LIBPREFIX") + name
+    if not name.endswith(env.subst("$LIBSUFFIX")):
+        name += env.subst("$LIBSUFFIX")
+    path = join(dirname(path), name)
+
+    cache = _get_library_cache(env)
+    key = make_key(name, _get_toolchain_versions(), key_parts)
+    cached_path = cache.lookup(key, name)
+    libcache_results.append(dict(library=name, key=key, hit=bool(cached_path)))
+    if cached_path:
+        return env.Command(path, cached_path, env.VerboseAction(
+            _copy_cached_archive, "Using cached %s" % name))
+
+    def _store(target, source, env):
+        cache.store(key, target[0].get_abspath(), dict(
+            meta or {}, board=board_config.id, library=name))
+
+    lib = env.StaticLibrary(path, source, ARFLAGS=["rc"])
+    env.AddPostAction(lib, env.VerboseAction(_store, "Caching $TARGET"))
+    return lib
+
+
+def _write_library_cache_report(
+        path=env.subst(join("$BUILD_DIR", "libcache.json"))):
+    if not libcache_results or env.GetOption("clean") or not isdir(
+            dirname(path)):
+        return
+    sizecheck.write_report(path, libcache_results)
+    hits = [item for item in libcache_results if item["hit"]]
+    print("Library cache: %d hits, %d misses (%s)" % (
+        len(hits), len(libcache_results) - len(hits), path))
+    if int(ARGUMENTS.get("PIOVERBOSE", 0)):
+        for item in libcache_results:
+            print("  %-4s %s (%s)" % (
+                "hit" if item["hit"] else "miss", item["library"],
+                item["key"][:10]))
+
+
+def _print_library_cache(target, source, env):
+    cache = _get_library_cache(env)
+    entries = cache.entries()
+    print("Library cache: %s" % cache.root)
+    for entry in entries:
+        meta = entry["meta"]
+        print("%s  %-10s %-8s %-30s %8d KB" % (
+            entry["key"][:10], meta.get("board", ""), meta.get("core", ""),
+            meta.get("library", ""), entry["size"] // 1024))
+    print("Total: %d entries, %d KB (limit %d KB)" % (
+        len(entries), sum(e["size"] for e in entries) // 1024,
+        cache.max_size // 1024))
+
+
+def _prune_library_cache(target, source, env):
+    for entry in _get_library_cache(env).prune():
+        print("Removed %s (%s)" % (entry["key"][:10],
+                                   entry["meta"].get("library", "")))
+
+
+env.AddMethod(BuildCachedLibrary)
+env.AddMethod(BuildCachedArchive)
+atexit.register(_write_library_cache_report)
+
+env.AddPlatformTarget(
+    "libcache",
+    None,
+    env.VerboseAction(_print_library_cache, "Inspecting library cache"),
+    "Library Cache",
+    "Show prebuilt framework libraries kept in the shared cache",
+)
+env.AddPlatformTarget(
+    "libcacheprune",
+    None,
+    env.VerboseAction(_prune_library_cache, "Pruning library cache"),
+    "Prune Library Cache",
+    "Evict least recently used libraries above the cache size limit",
+)
+
+#
+# Compiler cache (ccache 4.x)
+#
+
+CCACHE_RESULTS = (
+    ("hits", ("direct_cache_hit", "preprocessed_cache_hit")),
+    ("misses", ("cache_miss",)),
+)
+
+
+def _print_ccache_stats(path):
+    counters = {}
+    if isfile(path):
+        with open(path) as fp:
+            for line in fp:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    counters[line] = counters.get(line, 0) + 1
+    if not counters:
+        return
+    results = [
+        (title, sum(counters.get(name, 0) for name in names))
+        for title, names in CCACHE_RESULTS]
+    uncacheable = sum(counters.values()) - sum(value for _, value in results)
+    print("Compiler cache: %s, %d uncacheable" % (
+        ", ".join("%d %s" % (value, title) for title, value in results),
+        uncacheable))
+
+
+ccache = board_config.get("build.ccache", "no")
+if not boolopt.is_disabled(ccache):
+    env.Replace(
+        CCACHE="ccache" if env.IsEnabled(ccache) else ccache,
+        CCCOM="$CCACHE " + env["CCCOM"],
+        CXXCOM="$CCACHE " + env["CXXCOM"],
+    )
+    # Compiler binaries of PlatformIO packages get a new mtime on every
+    # reinstall, identify them by package version instead. Paths below
+    # the project directory are hashed relative to it, so CI checkouts in
+    # different locations share entries
+    env["ENV"].setdefault("CCACHE_DIR", board_config.get(
+        "build.ccache_dir", join(env.GetProjectConfig().get(
+            "platformio", "cache_dir"), "teensy", "ccache")))
+    env["ENV"].setdefault("CCACHE_BASEDIR", env.subst("$PROJECT_DIR"))
+    env["ENV"]["CCACHE_COMPILERCHECK"] = "string:%s" % ",".join(
+        _get_toolchain_versions())
+    # Per build statistics, the global ones are shared with other builds
+    ccache_stats_log = env.subst(join("$BUILD_DIR", "ccache-stats.log"))
+    if isfile(ccache_stats_log):
+        os.remove(ccache_stats_log)
+    env["ENV"]["CCACHE_STATSLOG"] = ccache_stats_log
+    atexit.register(_print_ccache_stats, ccache_stats_log)
+
+#
+# Target: Build the project for several boards concurrently
+#
+
+def _get_variants_config_path(name):
+    # outside of the build directory, which the child builds must not
+    # clean up while other variants still read the configuration
+    return join(env.subst("$PROJECT_WORKSPACE_DIR"), "teensy", name,
+                "platformio.ini")
+
+
+def _print_variants(env, variants, first_column, extra_columns=None):
+    extra_columns = extra_columns or []
+    rows = []
+    for variant in variants:
+        build_dir = join(env.subst("$PROJECT_BUILD_DIR"), variant.env_name)
+        if variant.status == "SUCCESS":
+            variant.sizes = matrix.read_sizes(
+                build_dir, env.subst("$PROGNAME"))
+        rows.append(
+            [variant.name] + [fn(variant) for _, fn in extra_columns] + [
+                variant.status, "%.1f" % variant.duration,
+                variant.sizes.get("program", "-"),
+                variant.sizes.get("data", "-")])
+        if variant.status != "SUCCESS":
+            sys.stderr.write(variant.output)
+    headers = [first_column] + [title for title, _ in extra_columns] + [
+        "Status", "Time (s)", "Flash", "RAM"]
+    print(matrix.format_table(headers, rows))
+    if any(v.status != "SUCCESS" for v in variants):
+        env.Exit(1)
+
+
+def _build_matrix(target, source, env):
+    boards = [b for b in re.split(
+        r"[\s,]+", env.GetProjectOption("custom_matrix_boards", "")) if b]
+    if not boards:
+        sys.stderr.write(
+            "Error: Please specify boards with `custom_matrix_boards` option\n")
+        env.Exit(1)
+
+    variants = []
+    for board_id in boards:
+        variants.append(matrix.Variant(
+            board_id, options=dict(board=board_id),
+            group=platform.board_config(board_id).get("build.core", "")))
+    config_path = matrix.write_config(
+        _get_variants_config_path("matrix"),
+        env.GetProjectConfig().path, env.subst("$PIOENV"), variants)
+    jobs = int(env.GetProjectOption("custom_matrix_jobs", 0)) or None
+    matrix.build_variants(
+        env.subst("$PYTHONEXE"), env.subst("$PROJECT_DIR"), config_path,
+        variants, jobs)
+
+    _print_variants(env, variants, "Board", [("Core", lambda v: v.group)])
+
+
+env.AddPlatformTarget(
+    "matrix",
+    None,
+    env.VerboseAction(_build_matrix, "Building board matrix"),
+    "Build Matrix",
+    "Build the project for every board from `custom_matrix_boards`",
+)
+
+#
+# Target: Build the project with every optimization profile
+#
+
+def _sweep_optimization_profiles(target, source, env):
+    profiles = env.get("ARDUINO_OPT_PROFILES")
+    if not profiles:
+        sys.stderr.write(
+            "Error: Optimization profiles are available only for the Arduino "
+            "framework with teensy3/teensy4 cores\n")
+        env.Exit(1)
+    selected = [p.upper() for p in re.split(
+        r"[\s,]+", env.GetProjectOption("custom_optsweep_profiles", "")) if p]
+    variants = [
+        matrix.Variant(name.lower(), options={
+            "board_build.arduino.opt_profile": name,
+            "board_build.arduino.core_cache": "no",
+            "board_build.link_timing": "yes",
+        }, environ={"CCACHE_DISABLE": "1"})
+        for name in profiles if not selected or name in selected
+    ]
+    config_path = matrix.write_config(
+        _get_variants_config_path("optsweep"),
+        env.GetProjectConfig().path, env.subst("$PIOENV"), variants)
+    # the timings are of full builds, nothing is reused from a previous
+    # sweep or from the compiler and library caches
+    for variant in variants:
+        build_dir = join(env.subst("$PROJECT_BUILD_DIR"), variant.env_name)
+        if isdir(build_dir):
+            rmtree(build_dir)
+    # one build at a time, otherwise the timings affect each other
+    matrix.build_variants(
+        env.subst("$PYTHONEXE"), env.subst("$PROJECT_DIR"), config_path,
+        variants, jobs=1)
+
+    # the link step is timed by the child build itself
+    link_times = {}
+    for variant in variants:
+        found = re.findall(r"^Link time: ([\d.]+) s$", variant.output, re.M)
+        if variant.status == "SUCCESS" and found:
+            link_times[variant.name] = float(found[-1])
+
+    def _link_time(variant):
+        return "%.1f" % link_times[variant.name] if (
+            variant.name in link_times) else "-"
+
+    def _compile_time(variant):
+        return "%.1f" % max(
+            0, variant.duration - link_times[variant.name]) if (
+                variant.name in link_times) else "-"
+
+    _print_variants(env, variants, "Profile", [
+        ("Compile (s)", _compile_time), ("Link (s)", _link_time)])
+
+
+env.AddPlatformTarget(
+    "optsweep",
+    None,
+    env.VerboseAction(_sweep_optimization_profiles,
+                      "Building optimization profile sweep"),
+    "Optimization Profile Sweep",
+    "Build the project with every optimization profile and compare them",
+)
+
+#
+# Target: Collect PGO profile data
+#
+
+def _collect_pgo_profile(target, source, env):
+    profile_dir = env.get("PGO_PROFILE_DIR")
+    if not profile_dir:
+        sys.stderr.write(
+            "Error: Please enable `board_build.arduino.pgo = generate`\n")
+        env.Exit(1)
+
+    dump_path = board_config.get("build.arduino.pgo_dump", "")
+    if dump_path:
+        with open(env.subst(dump_path)) as fp:
+            lines = fp.readlines()
+    else:
+        port = env.subst("$UPLOAD_PORT") or env.GetProjectOption(
+            "monitor_port", "")
+        if not port:
+            sys.stderr.write(
+                "Error: Please specify `upload_port` or `monitor_port`\n")
+            env.Exit(1)
+        print("Waiting for profile data on %s..." % port)
+        lines = pgo.read_serial(
+            port, int(env.GetProjectOption("monitor_speed", 115200)))
+
+    try:
+        records = pgo.parse_dump(lines)
+    except pgo.PgoError as exc:
+        sys.stderr.write("Error: %s\n" % exc)
+        env.Exit(1)
+    paths = pgo.write_profiles(records, profile_dir)
+    # keep the raw dump, so the profile can be replayed later
+    with open(join(profile_dir, "last_dump.txt"), "w") as fp:
+        fp.writelines(lines)
+    print("Stored %d profile files in %s" % (len(paths), profile_dir))
+
+
+env.AddPlatformTarget(
+    "pgocollect",
+    None,
+    env.VerboseAction(_collect_pgo_profile, "Collecting PGO profile data"),
+    "Collect PGO Profile",
+    "Read the profile dump from the board (or a recorded dump file)",
+)
+
+#
+# Profile-driven ITCM placement
+#
+
+def _get_hot_profile_path(env):
+    return env.subst(board_config.get(
+        "build.arduino.hot_profile",
+        join("$PROJECT_DIR", "hotprofile", "${PIOENV}.json")))
+
+
+def PlaceHotFunctions(env, ldscript_path):
+    profile_path = _get_hot_profile_path(env)
+    if not isfile(profile_path):
+        sys.stderr.write(
+            "Error: Missing hot function profile %s, please set "
+            "`board_build.arduino.hot_histogram` and run "
+            "`pio run -t hotprofile` first\n" % profile_path)
+        env.Exit(1)
+    budget = int(board_config.get("build.arduino.itcm_budget", 65536))
+    try:
+        profile = hotplace.load_profile(profile_path)
+        hot, cold = hotplace.select(profile, budget)
+        ldscript_dir = env.subst(join("$BUILD_DIR", "ldscript"))
+        if not isdir(ldscript_dir):
+            makedirs(ldscript_dir)
+        result = hotplace.write_ldscript(
+            ldscript_path, ldscript_dir, hot, cold)
+    except (IOError, ValueError, hotplace.HotPlaceError) as exc:
+        sys.stderr.write("Error: %s\n" % exc)
+        env.Exit(1)
+
+    functions = profile["functions"]
+    hot_samples = sum(functions[name]["samples"] for name in hot)
+    print("Hot placement: %d functions (%d bytes) in ITCM with %.1f%% of "
+          "the samples, %d functions in flash" % (
+              len(hot), sum(functions[name]["size"] for name in hot),
+              100.0 * hot_samples / max(profile["samples"], 1), len(cold)))
+    return result
+
+
+def _map_hot_histogram(target, source, env):
+    histogram_path = board_config.get("build.arduino.hot_histogram", "")
+    elf_path = env.subst(join("$BUILD_DIR", "${PROGNAME}.elf"))
+    if not histogram_path:
+        sys.stderr.write(
+            "Error: Please specify `board_build.arduino.hot_histogram`\n")
+        env.Exit(1)
+    if not isfile(elf_path):
+        sys.stderr.write(
+            "Error: Please build the profiled firmware first\n")
+        env.Exit(1)
+
+    try:
+        profile = hotplace.map_histogram(
+            elf_path, hotplace.read_histogram(env.subst(histogram_path)))
+    except (IOError, elf.ElfError, hotplace.HotPlaceError) as exc:
+        sys.stderr.write("Error: %s\n" % exc)
+        env.Exit(1)
+    profile_path = _get_hot_profile_path(env)
+    if not isdir(dirname(profile_path)):
+        makedirs(dirname(profile_path))
+    sizecheck.write_report(profile_path, profile)
+
+    sampled = sorted(
+        (item["samples"], name) for name, item in profile["functions"].items()
+        if item["samples"])
+    rows = [[name, profile["functions"][name]["size"], samples,
+             "%.1f%%" % (100.0 * samples / profile["samples"])]
+            for samples, name in reversed(sampled[-20:])]
+    print(matrix.format_table(["Function", "Size", "Samples", "Share"], rows))
+    print("Mapped %d of %d samples onto %d functions, stored in %s" % (
+        profile["samples"] - profile["unmapped"], profile["samples"],
+        len(sampled), profile_path))
+
+
+env.AddMethod(PlaceHotFunctions)
+
+env.AddPlatformTarget(
+    "hotprofile",
+    None,
+    env.VerboseAction(_map_hot_histogram, "Mapping PC samples to functions"),
+    "Map Hot Functions",
+    "Map a sampled PC histogram onto the functions of the built firmware",
+)
+
+#
+# Placement of source files and libraries in Teensy 4.x memories
+#
+
+placement_rules = []
+placed_objects = []
+
+
+def _place_object(env, node):
+    rule = placement.match(
+        placement_rules, node.srcnode().get_abspath(),
+        env.subst("$PROJECT_DIR"))
+    if not rule or not placement.REGIONS[rule[1]]:
+        return node
+    pattern, region = rule
+
+    def _rename_sections(target, source, env):
+        obj_path = target[0].get_abspath()
+        try:
+            renames = placement.rename_sections(obj_path, region)
+        except placement.PlacementError as exc:
+            sys.stderr.write("Warning! %s\n" % exc)
+            return None
+        if not renames:
+            return None
+        # a response file keeps long lists within the command line limit
+        args_path = obj_path + ".rename"
+        with open(args_path, "w") as fp:
+            fp.write("\n".join(
+                "--rename-section %s=%s" % item
+                for item in sorted(renames.items())))
+        result = env.Execute('$OBJCOPY @"%s" "%s"' % (args_path, obj_path))
+        os.remove(args_path)
+        return result
+
+    # the define rebuilds the object when its rule changes
+    obj = env.Object(node, CPPDEFINES=list(env.get("CPPDEFINES", [])) + [
+        ("TEENSY_PLACEMENT", region.split("-")[0].upper())])
+    env.AddPostAction(obj, env.VerboseAction(
+        _rename_sections, "Placing $TARGET in %s" % region.upper()))
+    placed_objects.append((obj[0].get_abspath(), pattern, region))
+    return obj
+
+
+def _print_placement(target, source, env):
+    report = {}
+    for obj_path, pattern, region in placed_objects:
+        item = report.setdefault(pattern, dict(region=region, files={}))
+        item["files"][obj_path] = placement.placed_size(obj_path, region)
+    sizecheck.write_report(
+        env.subst(join("$BUILD_DIR", "${PROGNAME}.placement.json")), report)
+    for pattern, item in sorted(report.items()):
+        print("Placement: %-30s %-13s %8d bytes from %d files" % (
+            pattern, item["region"].upper(), sum(item["files"].values()),
+            len(item["files"])))
+
+
+if board_config.get("build.arduino.placement", ""):
+    if build_core != "teensy4" or "arduino" not in env.get(
+            "PIOFRAMEWORK", []):
+        sys.stderr.write(
+            "Error: Placement rules need the Arduino framework for "
+            "Teensy 4.x\n")
+        env.Exit(1)
+    try:
+        placement_rules = placement.parse_rules(
+            board_config.get("build.arduino.placement"))
+    except placement.PlacementError as exc:
+        sys.stderr.write("Error: %s\n" % exc)
+        env.Exit(1)
+    if any(region == "extmem-noinit" for _, region in placement_rules) and (
+            "EXTMEM" not in board_config.get("upload.memory_regions", {})):
+        sys.stderr.write("Error: The board has no external memory\n")
+        env.Exit(1)
+    env.AddBuildMiddleware(_place_object)
+
+#
+# Target: Show the peripheral register read plan
+#
+
+def _print_register_read_plan(target, source, env):
+    svd_path = env.GetProjectOption("debug_svd_path", "") or (
+        board_config.get("debug.svd_path", ""))
+    if svd_path and not isfile(svd_path):
+        svd_path = join(platform.get_dir(), "misc", "svd", svd_path)
+    if not isfile(svd_path):
+        sys.stderr.write("Error: There is no SVD file for this board\n")
+        env.Exit(1)
+
+    index_path = svdindex.get_index_path(svd_path, join(
+        env.GetProjectConfig().get("platformio", "cache_dir"), "teensy", "svd"))
+    rows = []
+    with svdindex.SvdIndex(index_path) as index:
+        for name in index.peripheral_names():
+            peripheral = index.peripheral(name)
+            reads = regplan.plan(peripheral)
+            planned = sum(len(read.registers) for read in reads)
+            rows.append([
+                name, "0x%08X" % peripheral.base_address,
+                len(peripheral.registers), planned,
+                len(peripheral.registers) - planned, len(reads)])
+    print(matrix.format_table(
+        ["Peripheral", "Base", "Registers", "Read", "Skipped", "Reads"], rows))
+    print("Total: %d registers in %d reads" % (
+        sum(row[3] for row in rows), sum(row[5] for row in rows)))
+
+
+env.AddPlatformTarget(
+    "regplan",
+    None,
+    env.VerboseAction(_print_register_read_plan,
+                      "Planning peripheral register reads"),
+    "Register Read Plan",
+    "Show how peripheral registers from the board SVD are read in blocks",
+)
+
+#
+# Per-command build timing report
+#
+
+if env.IsEnabled(board_config.get("build.timing_report", "no")):
+    timing_ftime_report = env.IsEnabled(
+        board_config.get("build.timing_ftime_report", "no"))
+    build_timer = buildtimer.BuildTimer(env["SPAWN"], timing_ftime_report)
+    env.Replace(SPAWN=build_timer.spawn)
+    if timing_ftime_report:
+        env.Append(CCFLAGS=["-ftime-report"])
+
+    def _write_timing_report(
+            path=env.subst(join("$BUILD_DIR", "build_timing.json")),
+            top=int(board_config.get("build.timing_top", 10))):
+        if not build_timer.records:
+            return
+        build_timer.write_report(path)
+        print(build_timer.summary(top))
+        print("Timing report: %s" % path)
+
+    atexit.register(_write_timing_report)
 
 #
 # Target: Build executable and linkable firmware
@@ -173,6 +1008,21 @@ if "nobuild" in COMMAND_LINE_TARGETS:
     target_firm = join("$BUILD_DIR", "${PROGNAME}.hex")
 else:
     target_elf = env.BuildProgram()
+    if env.IsEnabled(board_config.get("build.link_timing", "no")):
+        link_started = []
+
+        def _start_link_timer(target, source, env):
+            link_started.append(time.time())
+
+        def _print_link_time(target, source, env):
+            print("Link time: %.2f s" % (time.time() - link_started[-1]))
+
+        env.AddPreAction(target_elf, env.VerboseAction(_start_link_timer, ""))
+        env.AddPostAction(target_elf, env.VerboseAction(_print_link_time, ""))
+    if placement_rules:
+        env.AddPostAction(target_elf, env.VerboseAction(_print_placement, ""))
+    for action in env.get("PROGRAM_POSTACTIONS", []):
+        env.AddPostAction(target_elf, action)
     target_firm = env.ElfToHex(join("$BUILD_DIR", "${PROGNAME}"), target_elf)
     env.Depends(target_firm, "checkprogsize")
 
@@ -188,6 +1038,38 @@ target_size = env.Alias(
     env.VerboseAction("$SIZEPRINTCMD", "Calculating size $SOURCE"))
 AlwaysBuild(target_size)
 
+
+def _print_memory_advice(target, source, env):
+    regions = memregions.load_regions(
+        board_config.get("upload.memory_regions", {}))
+    banked = [r for r in regions if r.bank_size]
+    if not banked:
+        sys.stderr.write("Error: The board has no banked memory regions\n")
+        env.Exit(1)
+    elf_path = source[0].get_abspath()
+    report = memregions.account(
+        elf_path, regions, board_config.get("upload.memory_pools", {}))
+    for region in banked:
+        item = report["regions"][region.name]
+        print("%s: %d bytes of code, %d bytes allocated in %d byte banks" % (
+            region.name, item["used"], item["allocated"], region.bank_size))
+        rows = [
+            [row["name"], row["size"], row["moved"], row["recovered"]]
+            for row in memregions.bank_advice(
+                elf_path, region, report,
+                int(board_config.get("build.memadvisor_limit", 20)))]
+        print(matrix.format_table(
+            ["Function", "Size", "Moved", "Recovered"], rows))
+
+
+env.AddPlatformTarget(
+    "memadvisor",
+    target_elf,
+    env.VerboseAction(_print_memory_advice, "Analyzing memory banks"),
+    "Memory Advisor",
+    "List the largest ITCM functions and the DTCM freed by moving them",
+)
+
 #
 # Target: Upload by default firmware file
 #
@@ -203,8 +1085,63 @@ if env.subst("$UPLOAD_PROTOCOL") == "teensy-gui" and not isfile(
 upload_protocol = env.subst("$UPLOAD_PROTOCOL")
 upload_actions = []
 
+# Remember the image uploaded to every J-Link probe or fleet device and skip
+# unchanged uploads, "pio run -t forceupload" uploads unconditionally
+upload_state = None
+if env.IsEnabled(board_config.get("upload.skip_unchanged", "no")):
+    upload_state = UploadState(join(
+        env.GetProjectConfig().get("platformio", "cache_dir"), "teensy",
+        "uploads.json"))
+force_upload = "forceupload" in COMMAND_LINE_TARGETS
+
+
+upload_port = env.subst("$UPLOAD_PORT")
+
+
+def _upload_device_id(serial):
+    # the serial number the uploader is bound to, the Teensy loaders flash
+    # whichever board responds and have no identity to record
+    if not serial:
+        return None
+    return "%s:%s:%s" % (upload_protocol, board_config.id, serial)
+
+
+def _skip_unchanged_upload(actions, serial):
+    def _upload(target, source, env):
+        device = _upload_device_id(serial)
+        digest = image_hash(source[0].get_abspath())
+        if device and not force_upload and upload_state.is_current(
+                device, digest):
+            print("Firmware on %s is up to date, skipping upload "
+                  "(use `-t forceupload` to override)" % device)
+            return 0
+        for action in actions:
+            result = action(target, source, env)
+            if result:
+                return result
+        if device:
+            upload_state.record(device, digest)
+        return 0
+
+    return [env.VerboseAction(_upload, "Checking firmware on $UPLOAD_PROTOCOL device")]
+
+
 if upload_protocol.startswith("jlink"):
 
+    # the serial number of the probe, "upload_port" of J-Link uploads
+    jlink_serial = upload_port if upload_port.isdigit() else None
+    jlink_incremental = env.IsEnabled(
+        board_config.get("upload.jlink_incremental", "no"))
+    if jlink_incremental and not jlink_serial:
+        sys.stderr.write(
+            "Warning! Incremental J-Link uploads need the serial number of "
+            "the probe in `upload_port`, loading the full image\n")
+        jlink_incremental = False
+    # the image flashed last time, used as a baseline by incremental uploads
+    jlink_baseline = join(
+        env.GetProjectConfig().get("platformio", "cache_dir"), "teensy",
+        "jlink", "%s.hex" % make_key(_upload_device_id(jlink_serial))[:16])
+
     def _jlink_cmd_script(env, source):
         build_dir = env.subst("$BUILD_DIR")
         if not isdir(build_dir):
@@ -215,6 +1152,31 @@ if upload_protocol.startswith("jlink"):
             fp.write("\n".join(commands))
         return script_path
 
+    def _write_jlink_diff_script(target, source, env):
+        # runs once per upload, unlike the substitution of UPLOADCMD
+        if not isfile(jlink_baseline):
+            _jlink_cmd_script(env, source[0])
+            return None
+        build_dir = env.subst("$BUILD_DIR")
+        program, erase = jlinkdiff.plan(
+            jlinkdiff.read_ihex(jlink_baseline),
+            jlinkdiff.read_ihex(source[0].get_abspath()),
+            int(board_config.get("upload.jlink_sector_size", 4096)))
+        commands = jlinkdiff.commands(
+            program, erase, join(build_dir, "jlink"),
+            env.IsEnabled(board_config.get("upload.jlink_verify", "no")))
+        with open(join(build_dir, "upload.jlink"), "w") as fp:
+            fp.write("\n".join(commands))
+        # the baseline is saved again only after a successful upload,
+        # a failed one leaves the flash contents unknown
+        os.remove(jlink_baseline)
+        return None
+
+    def _save_jlink_baseline(target, source, env):
+        if not isdir(dirname(jlink_baseline)):
+            makedirs(dirname(jlink_baseline))
+        copyfile(source[0].get_abspath(), jlink_baseline)
+
     env.Replace(
         __jlink_cmd_script=_jlink_cmd_script,
         UPLOADER="JLink.exe" if system() == "Windows" else "JLinkExe",
@@ -223,11 +1185,23 @@ if upload_protocol.startswith("jlink"):
             "-speed", env.GetProjectOption("debug_speed", "4000"),
             "-if", ("jtag" if upload_protocol == "jlink-jtag" else "swd"),
             "-autoconnect", "1",
-            "-NoGui", "1"
-        ],
+            "-NoGui", "1",
+            "-ExitOnError", "1"
+        ] + (["-USB", jlink_serial] if jlink_serial else []),
         UPLOADCMD='$UPLOADER $UPLOADERFLAGS -CommanderScript "${__jlink_cmd_script(__env__, SOURCE)}"'
     )
     upload_actions = [env.VerboseAction("$UPLOADCMD", "Uploading $SOURCE")]
+    if jlink_incremental:
+        env.Replace(
+            UPLOADCMD='$UPLOADER $UPLOADERFLAGS -CommanderScript "%s"' % join(
+                "$BUILD_DIR", "upload.jlink"))
+        upload_actions = [
+            env.VerboseAction(_write_jlink_diff_script,
+                              "Comparing $SOURCE with the flashed image"),
+            env.VerboseAction("$UPLOADCMD", "Uploading $SOURCE"),
+            env.VerboseAction(
+                _save_jlink_baseline, "Saving flashed image as baseline"),
+        ]
 
 elif upload_protocol == "teensy-cli":
     env.Replace(
@@ -246,6 +1220,59 @@ elif upload_protocol == "teensy-cli":
         env.VerboseAction("$UPLOADCMD", "Uploading $SOURCE")
     ]
 
+    if board_config.get("upload.fleet", ""):
+
+        def _fleet_upload(target, source, env):
+            sysenv = environ.copy()
+            sysenv["PATH"] = str(env["ENV"]["PATH"])
+            loader = env.subst("$FLEET_UPLOADER")
+            serials = [s for s in re.split(
+                r"[\s,]+", board_config.get("upload.fleet")) if s]
+            if serials == ["all"]:
+                serials = fleet.discover(
+                    loader, env.subst("$FLEET_LISTFLAGS"),
+                    board_config.get("name"), env=sysenv)
+            if not serials:
+                sys.stderr.write("Error: No devices found for fleet upload\n")
+                env.Exit(1)
+
+            digest = image_hash(source[0].get_abspath())
+            if upload_state and not force_upload:
+                for serial in list(serials):
+                    if upload_state.is_current(
+                            _upload_device_id(serial), digest):
+                        print("Firmware on %s is up to date, skipping" %
+                              serial)
+                        serials.remove(serial)
+
+            results = fleet.flash(
+                serials, loader, env.subst("$FLEET_UPLOADERFLAGS"),
+                source[0].get_abspath(),
+                int(board_config.get("upload.fleet_jobs", 4)), env=sysenv)
+            for result in results:
+                if upload_state and result["returncode"] == 0:
+                    upload_state.record(
+                        _upload_device_id(result["serial"]), digest)
+                if result["returncode"] != 0:
+                    sys.stderr.write(result["output"])
+            print(matrix.format_table(
+                ["Device", "Status", "Time (s)"],
+                [[r["serial"], "SUCCESS" if r["returncode"] == 0 else "FAILED",
+                  "%.1f" % r["duration"]] for r in results]))
+            if any(r["returncode"] != 0 for r in results):
+                env.Exit(1)
+
+        env.Replace(
+            FLEET_UPLOADER=board_config.get("upload.fleet_loader", "tycmd"),
+            FLEET_LISTFLAGS=board_config.get(
+                "upload.fleet_list_flags", "list --output json"),
+            FLEET_UPLOADERFLAGS=board_config.get(
+                "upload.fleet_flags", "upload --board {serial} {firmware}"),
+        )
+        upload_actions = [
+            env.VerboseAction(_fleet_upload, "Uploading $SOURCE to fleet")
+        ]
+
 elif upload_protocol == "teensy-gui":
     env.Replace(
         UPLOADER="teensy_post_compile",
@@ -266,7 +1293,11 @@ elif upload_protocol == "custom":
 else:
     sys.stderr.write("Warning! Unknown upload protocol %s\n" % upload_protocol)
 
+if upload_state and upload_protocol.startswith("jlink"):
+    upload_actions = _skip_unchanged_upload(upload_actions, jlink_serial)
+
 AlwaysBuild(env.Alias("upload", target_firm, upload_actions))
+AlwaysBuild(env.Alias("forceupload", target_firm, upload_actions))
 
 #
 # Default targets
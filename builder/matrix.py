@@ -0,0 +1,133 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Build one project for several boards (or build variants) concurrently.
+
+Every variant becomes a generated "[env:...]" section that extends the
+current environment. The generated configuration includes the user's
+"platformio.ini" via "extra_configs", so all options are inherited and
+each variant gets its own build directory. Variants are then built by a
+bounded pool of "pio run" worker processes.
+"""
+
+import json
+import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os.path import isdir, isfile, join
+
+
+class Variant(object):
+
+    def __init__(self, name, options=None, environ=None, group=None):
+        self.name = name
+        self.options = options or {}
+        self.environ = environ or {}
+        self.group = group
+        self.env_name = None
+        self.status = None
+        self.duration = 0
+        self.sizes = {}
+        self.output = ""
+
+
+def write_config(path, project_config, base_env, variants):
+    lines = ["[platformio]", "extra_configs = %s" % project_config, ""]
+    for variant in variants:
+        variant.env_name = "%s_%s" % (base_env, variant.name)
+        lines.append("[env:%s]" % variant.env_name)
+        lines.append("extends = env:%s" % base_env)
+        for key, value in variant.options.items():
+            lines.append("%s = %s" % (key, value))
+        lines.append("")
+    if not isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "w") as fp:
+        fp.write("\n".join(lines))
+    return path
+
+
+def _pio_command(python_exe, project_dir, config_path, variant, *args):
+    return [python_exe, "-m", "platformio"] + list(args) + [
+        "-d", project_dir, "-c", config_path, "-e", variant.env_name]
+
+
+def _run(cmd, environ=None):
+    sysenv = os.environ.copy()
+    sysenv.update(environ or {})
+    start = time.time()
+    proc = subprocess.run(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=sysenv,
+        universal_newlines=True)
+    return proc.returncode, time.time() - start, proc.stdout
+
+
+def read_sizes(build_dir, progname="firmware"):
+    # written by the size check of the variant, with the size regexps of
+    # its own board
+    report_path = join(build_dir, "%s.size.json" % progname)
+    if not isfile(report_path):
+        return {}
+    with open(report_path) as fp:
+        return json.load(fp)
+
+
+def run_variant(python_exe, project_dir, config_path, variant, targets=None):
+    # the generated configuration differs from the one of the parent build,
+    # the automatic clean would remove the build directories of all others
+    args = ["run", "--disable-auto-clean"]
+    for target in targets or []:
+        args.extend(["-t", target])
+    return _run(
+        _pio_command(python_exe, project_dir, config_path, variant, *args),
+        variant.environ)
+
+
+def build_variants(python_exe, project_dir, config_path, variants, jobs=None,
+                   targets=None):
+    def _build(variant):
+        returncode, variant.duration, variant.output = run_variant(
+            python_exe, project_dir, config_path, variant, targets)
+        variant.status = "SUCCESS" if returncode == 0 else "FAILED"
+        return variant
+
+    # the first variant of every group (e.g. per "build.core") is built alone,
+    # so packages are resolved/installed once and the concurrent workers
+    # never race on the package manager
+    leaders = []
+    others = []
+    for variant in variants:
+        if variant.group is not None and variant.group not in [
+                v.group for v in leaders]:
+            leaders.append(variant)
+        else:
+            others.append(variant)
+    for variant in leaders:
+        _build(variant)
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+        list(executor.map(_build, others))
+    return variants
+
+
+def format_table(headers, rows):
+    widths = [len(h) for h in headers]
+    for row in rows:
+        widths = [max(w, len(str(c))) for w, c in zip(widths, row)]
+    lines = ["  ".join(str(h).ljust(w) for h, w in zip(headers, widths))]
+    lines.append("  ".join("-" * w for w in widths))
+    for row in rows:
+        lines.append("  ".join(str(c).ljust(w) for c, w in zip(row, widths)))
+    return "\n".join(lines)
@@ -0,0 +1,123 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Memory usage per region, as declared by "upload.memory_regions" and
+"upload.memory_pools" of a board manifest.
+
+Sections are assigned to regions by their address, initialized data is
+also charged to the region of its load address. Regions with a bank size
+(i.MX RT ITCM) are allocated in whole banks, and regions sharing a pool
+(ITCM and DTCM share the 512 KB of RAM1) are checked against it together.
+"""
+
+from collections import namedtuple
+
+from elf import SHF_ALLOC, SHT_NOBITS, STT_FUNC, ElfFile
+
+Region = namedtuple(
+    "Region", "name origin length bank_size pool load optional")
+
+
+def _int(value):
+    return int(value, 0) if isinstance(value, str) else int(value)
+
+
+def load_regions(manifest):
+    return sorted([
+        Region(name, _int(item.get("origin", 0)), _int(item["length"]),
+               _int(item.get("bank_size", 0)), item.get("pool"),
+               bool(item.get("load")), bool(item.get("optional")))
+        for name, item in manifest.items()], key=lambda r: r.origin)
+
+
+def find_region(regions, address, load=False):
+    for region in regions:
+        if region.load == load and (
+                region.origin <= address < region.origin + region.length):
+            return region
+    if not load:
+        return find_region(regions, address, load=True)
+    return None
+
+
+def _round_up(value, bank_size):
+    return -(-value // bank_size) * bank_size if bank_size else value
+
+
+def account(elf_path, regions, pools=None):
+    usage = {r.name: dict(used=0, padding=0) for r in regions}
+    with ElfFile(elf_path) as elf:
+        for section in elf.sections:
+            if not section.flags & SHF_ALLOC or not section.size:
+                continue
+            region = find_region(regions, section.addr)
+            if region:
+                key = "padding" if section.name.endswith(".padding") else (
+                    "used")
+                usage[region.name][key] += section.size
+            if section.type == SHT_NOBITS or section.lma == section.addr:
+                continue
+            load_region = find_region(regions, section.lma, load=True)
+            if load_region:
+                usage[load_region.name]["used"] += section.size
+
+    result = dict(regions={}, pools={})
+    for region in regions:
+        item = usage[region.name]
+        item.update(
+            length=region.length,
+            allocated=max(item["used"] + item["padding"],
+                          _round_up(item["used"], region.bank_size)))
+        result["regions"][region.name] = item
+    for name, length in (pools or {}).items():
+        result["pools"][name] = dict(length=_int(length), used=sum(
+            result["regions"][r.name]["allocated"]
+            for r in regions if r.pool == name))
+    return result
+
+
+def check(report, regions):
+    """Return the names of regions and pools over their budget"""
+    errors = [
+        r.name for r in regions
+        if report["regions"][r.name]["allocated"] > r.length]
+    errors.extend(
+        name for name, item in report["pools"].items()
+        if item["used"] > item["length"])
+    return errors
+
+
+def bank_advice(elf_path, region, report, limit=10):
+    """
+    List the largest functions of a banked region (largest first) with the
+    bytes of the pool that are given back once they and all functions
+    above them are moved to flash.
+    """
+    used = report["regions"][region.name]["used"]
+    allocated = report["regions"][region.name]["allocated"]
+    with ElfFile(elf_path) as elf:
+        functions = sorted(
+            (s for s in elf.symbols()
+             if s.type == STT_FUNC and s.size and
+             region.origin <= s.value < region.origin + region.length),
+            key=lambda s: s.size, reverse=True)
+    rows = []
+    moved = 0
+    for symbol in functions[:limit]:
+        moved += symbol.size
+        rows.append(dict(
+            name=symbol.name, size=symbol.size, moved=moved,
+            recovered=allocated - _round_up(used - moved, region.bank_size)))
+    return rows
@@ -0,0 +1,99 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Host side of the profile-guided optimization workflow.
+
+The on-target runtime ("misc/pgo/teensy_pgo.cpp") prints one hex encoded
+line per translation unit between "#pgo-begin" and "#pgo-end" markers.
+Every line is a "gcfn" filename record followed by the .gcda payload, as
+produced by "__gcov_filename_to_gcfn" and "__gcov_info_to_gcda".
+"""
+
+import os
+import time
+from os.path import basename, isdir, join
+
+BEGIN_MARKER = "#pgo-begin"
+END_MARKER = "#pgo-end"
+GCDA_MAGIC = (b"adcg", b"gcda")  # little and big endian
+
+
+class PgoError(Exception):
+    pass
+
+
+def parse_record(data):
+    """Split one decoded record into (gcda file name, gcda content)"""
+    # magic, version, string length, then the NUL terminated file name
+    name_end = data.find(b"\0", 12)
+    if name_end == -1:
+        raise PgoError("Malformed profile record")
+    filename = data[12:name_end].decode("utf-8", "replace")
+    for magic in GCDA_MAGIC:
+        pos = data.find(magic, name_end)
+        if pos != -1:
+            return filename, data[pos:]
+    raise PgoError("Missing .gcda payload for %s" % filename)
+
+
+def parse_dump(lines):
+    records = []
+    started = False
+    for line in lines:
+        line = line.strip()
+        if line == BEGIN_MARKER:
+            started = True
+            records = []
+        elif line == END_MARKER and started:
+            return records
+        elif started and line:
+            try:
+                records.append(parse_record(bytes.fromhex(line)))
+            except ValueError:
+                raise PgoError("Corrupted profile line: %s..." % line[:32])
+    raise PgoError("Incomplete profile dump, no `%s` marker" % END_MARKER)
+
+
+def write_profiles(records, profile_dir):
+    """
+    Store the .gcda files under their mangled names (the object path is
+    already encoded in the name by "-fprofile-generate=<dir>"), so a dump
+    recorded on another machine can be reused.
+    """
+    if not isdir(profile_dir):
+        os.makedirs(profile_dir)
+    result = []
+    for filename, content in records:
+        path = join(profile_dir, basename(filename.replace("\\", "/")))
+        with open(path, "wb") as fp:
+            fp.write(content)
+        result.append(path)
+    return result
+
+
+def read_serial(port, baudrate=115200, timeout=60):
+    import serial  # pylint: disable=import-outside-toplevel
+
+    lines = []
+    deadline = time.time() + timeout
+    with serial.Serial(port, baudrate, timeout=1) as ser:
+        while time.time() < deadline:
+            line = ser.readline().decode("ascii", "replace")
+            if not line:
+                continue
+            lines.append(line)
+            if line.strip() == END_MARKER:
+                break
+    return lines
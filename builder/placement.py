@@ -0,0 +1,118 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Placement of whole source files and libraries into Teensy 4.x memories.
+
+Rules map source globs or "lib:<name>" patterns to a region, the first
+matching rule wins. The sections of the matching objects are renamed to
+the sections of the FASTRUN, FLASHMEM, PROGMEM, DMAMEM and EXTMEM
+attributes, which the Teensy 4 linker scripts already place, so the effect
+is the same as annotating every function and variable of the file.
+"""
+
+import fnmatch
+import os
+from os.path import relpath
+
+from elf import ElfFile
+
+# region: [(input section prefix, new name, keep the original name)]
+REGIONS = {
+    "itcm": [(".text", ".fastrun", False)],
+    "dtcm": [],
+    "flash": [(".text", ".flashmem", True), (".rodata", ".progmem", True)],
+    # like DMAMEM and EXTMEM variables, these are not zeroed at startup
+    "ocram-noinit": [(".bss", ".dmabuffers", False)],
+    "extmem-noinit": [(".bss", ".externalram", False)],
+}
+LIBRARY_PARENTS = ("lib", "libraries")
+
+
+class PlacementError(Exception):
+    pass
+
+
+def parse_rules(text):
+    """Parse "<glob or lib:name> = <region>" items, one per line or comma"""
+    rules = []
+    for item in text.replace(",", "\n").splitlines():
+        item = item.strip()
+        if not item:
+            continue
+        pattern, _, region = item.rpartition("=")
+        pattern, region = pattern.strip(), region.strip().lower()
+        if pattern and region + "-noinit" in REGIONS:
+            raise PlacementError(
+                "Invalid placement rule `%s`, the startup code doesn't zero "
+                "variables in %s, use `%s-noinit` if the code initializes "
+                "them itself" % (item, region.upper(), region))
+        if not pattern or region not in REGIONS:
+            raise PlacementError(
+                "Invalid placement rule `%s`, expected `<pattern> = <%s>`" % (
+                    item, "|".join(sorted(REGIONS))))
+        rules.append((pattern, region))
+    return rules
+
+
+def _is_library_file(path, name):
+    parts = path.replace("\\", "/").split("/")
+    for i, part in enumerate(parts[:-1]):
+        if fnmatch.fnmatchcase(part, name) and i and (
+                parts[i - 1] in LIBRARY_PARENTS or
+                (i > 1 and parts[i - 2] == "libdeps")):
+            return True
+    return False
+
+
+def match(rules, path, project_dir):
+    """Return the first (pattern, region) rule for source `path`"""
+    try:
+        candidates = [relpath(path, project_dir).replace("\\", "/"), path]
+    except ValueError:  # another drive
+        candidates = [path]
+    for pattern, region in rules:
+        if pattern.startswith("lib:"):
+            if _is_library_file(path, pattern[4:]):
+                return pattern, region
+        elif any(fnmatch.fnmatch(c, pattern) for c in candidates):
+            return pattern, region
+    return None
+
+
+def rename_sections(object_path, region):
+    """Return {old name: new name} for the sections of an object file"""
+    result = {}
+    with ElfFile(object_path) as elf:
+        names = [s.name for s in elf.sections]
+    if any(name.startswith(".gnu.lto_") for name in names):
+        raise PlacementError(
+            "%s contains LTO bytecode and can't be placed" % object_path)
+    for name in names:
+        for prefix, new_name, keep in REGIONS[region]:
+            if name == prefix or name.startswith(prefix + "."):
+                result[name] = new_name + name if keep else new_name
+    return result
+
+
+def placed_size(object_path, region):
+    """Size of the sections that were moved to `region`"""
+    new_names = [new_name for _, new_name, _ in REGIONS[region]]
+    if not new_names or not os.path.isfile(object_path):
+        return 0
+    with ElfFile(object_path) as elf:
+        return sum(
+            s.size for s in elf.sections
+            if any(s.name == n or s.name.startswith(n + ".")
+                   for n in new_names))
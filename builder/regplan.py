@@ -0,0 +1,101 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Plan peripheral register reads as a few block reads.
+
+Registers of the same width that are back to back in memory are merged
+into one read of that access width. Gaps are never read, since reserved
+addresses may fault. Registers with read side effects are left out.
+"""
+
+import fnmatch
+from collections import namedtuple
+
+MAX_READ_SIZE = 1024
+
+# Data and result registers of the Kinetis SVDs which are not marked with
+# a "readAction", although reading them pops a FIFO or clears a flag
+READ_SENSITIVE = [
+    "ADC*.R[AB]",
+    "I2C*.D",
+    "SPI*.DH",
+    "SPI*.DL",
+    "SPI*.POPR",
+    "UART*.D",
+]
+
+Read = namedtuple("Read", "address width size registers")
+
+
+def is_read_sensitive(register):
+    return bool(register.read_action) or any(
+        field.read_action for field in register.fields)
+
+
+def is_readable(register, skip=None, peripheral_name=""):
+    if register.access == "write-only" or is_read_sensitive(register):
+        return False
+    name = "%s.%s" % (peripheral_name, register.name)
+    return not any(
+        fnmatch.fnmatchcase(name, pattern)
+        for pattern in READ_SENSITIVE + (skip or []))
+
+
+def plan(peripheral, skip=None, max_read_size=MAX_READ_SIZE):
+    """
+    Return a list of `Read` for the readable registers of `peripheral`.
+    `skip` holds "PERIPHERAL.REGISTER" patterns of extra registers that
+    must not be read. Registers which alias an already planned address
+    range (alternate views) reuse that read.
+    """
+    reads = []
+    registers = sorted(
+        (r for r in peripheral.registers
+         if is_readable(r, skip, peripheral.name)),
+        key=lambda r: (r.offset, -r.size))
+    for register in registers:
+        address = peripheral.base_address + register.offset
+        width = register.size // 8
+        current = reads[-1] if reads else None
+        if current and current.width == width and (
+                current.address <= address and
+                address + width <= current.address + current.size):
+            current.registers.append(register)
+        elif current and current.width == width and (
+                address == current.address + current.size and
+                current.size + width <= max_read_size):
+            reads[-1] = current._replace(size=current.size + width)
+            reads[-1].registers.append(register)
+        else:
+            reads.append(Read(address, width, width, [register]))
+    return reads
+
+
+def decode(peripheral, reads, data):
+    """
+    Decode the raw little endian `data` of every read into a list of
+    (register, value, [(field, value)])
+    """
+    result = []
+    for read, chunk in zip(reads, data):
+        for register in read.registers:
+            start = peripheral.base_address + register.offset - read.address
+            value = int.from_bytes(
+                bytes(chunk[start:start + register.size // 8]), "little")
+            result.append((register, value, [
+                (field, (value >> field.bit_offset) &
+                 ((1 << field.bit_width) - 1))
+                for field in register.fields]))
+    return sorted(result, key=lambda item: item[0].offset)
@@ -0,0 +1,60 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Program/data usage computed straight from the ELF section table.
+
+The section sets are the ones selected by $SIZEPROGREGEXP/$SIZEDATAREGEXP:
+each section header is rendered the way "size -A -d" prints it and matched
+against the same expressions, so the totals are identical to the toolchain
+based check without running a process or parsing its output.
+"""
+
+import json
+import re
+
+from elf import ElfFile
+
+
+def section_sizes(elf_path):
+    with ElfFile(elf_path) as elf:
+        return [(s.name, s.size, s.addr) for s in elf.sections if s.name]
+
+
+def calculate(elf_path, prog_regexp, data_regexp):
+    prog_re = re.compile(prog_regexp) if prog_regexp else None
+    data_re = re.compile(data_regexp) if data_regexp else None
+    result = dict(program=0, data=0, sections={})
+    for name, size, addr in section_sizes(elf_path):
+        line = "%-20s %10d %10d" % (name, size, addr)
+        result["sections"][name] = result["sections"].get(name, 0) + size
+        if prog_re and prog_re.match(line):
+            result["program"] += size
+        if data_re and data_re.match(line):
+            result["data"] += size
+    return result
+
+
+def format_usage(value, total):
+    percent_raw = float(value) / float(total)
+    blocks_per_progress = 10
+    used_blocks = min(
+        int(round(blocks_per_progress * percent_raw, 0)), blocks_per_progress)
+    return "[{:{}}] {: 6.1%} (used {:d} bytes from {:d} bytes)".format(
+        "=" * used_blocks, blocks_per_progress, percent_raw, value, total)
+
+
+def write_report(path, report):
+    with open(path, "w") as fp:
+        json.dump(report, fp, indent=2, sort_keys=True)
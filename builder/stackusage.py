@@ -0,0 +1,291 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Worst-case stack depth of the firmware entry points.
+
+Frame sizes come from the "-fstack-usage" (.su) or "-fcallgraph-info=su"
+(.ci) files of the build. The call graph comes from the .ci files (GCC 10+)
+or, for older toolchains, from the direct calls found in the ELF code of
+Thumb and AVR functions. Indirect calls, recursion and dynamic frames can't
+be bounded and are reported next to the results.
+"""
+
+import os
+import re
+import struct
+from os.path import join
+
+from elf import SHT_NOBITS, STT_FUNC, ElfFile
+
+EM_AVR = 83
+EM_ARM = 40
+
+INDIRECT_CALL = "__indirect_call"
+RESET_HANDLERS = ("ResetHandler", "Reset_Handler", "main")
+ISR_NAME_RE = re.compile(r"^(__vector_\d+|\w+_isr|\w+_IRQHandler)$")
+VECTOR_TABLES = ("_VectorsFlash", "__isr_vector", "g_pfnVectors")
+
+CI_NODE_RE = re.compile(r'^node: \{ title: "([^"]+)" label: "([^"]*)"')
+CI_EDGE_RE = re.compile(
+    r'^edge: \{ sourcename: "([^"]+)" targetname: "([^"]+)"')
+CI_STACK_RE = re.compile(r"\\n(\d+) bytes \(([\w,]+)\)")
+SU_LINE_RE = re.compile(r"^(.*?):(\d+):(\d+):(.*)\t(\d+)\t([\w,]+)$")
+
+
+class CallGraph(object):
+
+    def __init__(self):
+        self.frames = {}  # name: (size, "static", "dynamic" or "bounded")
+        self.calls = {}
+
+    def add_frame(self, name, size, qualifier):
+        # local functions of different units may share a name, keep the
+        # larger frame, which is the conservative choice
+        if name not in self.frames or self.frames[name][0] < size:
+            self.frames[name] = (size, qualifier)
+
+    def add_call(self, caller, callee):
+        self.calls.setdefault(caller, set()).add(callee)
+
+
+def find_files(build_dir, suffix):
+    for root, _, names in os.walk(build_dir):
+        for name in names:
+            if name.endswith(suffix):
+                yield join(root, name)
+
+
+def parse_callgraph_info(paths, graph=None):
+    graph = graph or CallGraph()
+    for path in paths:
+        with open(path, errors="replace") as fp:
+            for line in fp:
+                match = CI_NODE_RE.match(line)
+                if match:
+                    stack = CI_STACK_RE.search(match.group(2))
+                    if stack:
+                        graph.add_frame(
+                            match.group(1), int(stack.group(1)),
+                            stack.group(2))
+                    continue
+                match = CI_EDGE_RE.match(line)
+                if match:
+                    graph.add_call(match.group(1), match.group(2))
+    return graph
+
+
+def parse_stack_usage(paths):
+    """Return {printable function name: (size, qualifier)} from .su files"""
+    result = {}
+    for path in paths:
+        with open(path, errors="replace") as fp:
+            for line in fp:
+                match = SU_LINE_RE.match(line.rstrip("\r\n"))
+                if not match:
+                    continue
+                name, size = match.group(4), int(match.group(5))
+                if name not in result or result[name][0] < size:
+                    result[name] = (size, match.group(6))
+    return result
+
+
+def match_stack_usage(usage, symbol_names, demangle=None):
+    """
+    Map the printable names of .su files ("int ns::foo(int)") to symbol
+    names ("_ZN2ns3fooEi"). `demangle` turns a list of symbol names into
+    a list of demangled names.
+    """
+    by_name = {}
+    demangled = demangle(symbol_names) if demangle else symbol_names
+    for name, plain in zip(symbol_names, demangled):
+        by_name.setdefault(plain, []).append(name)
+    result = {}
+    for printable, frame in usage.items():
+        # drop the return type, one word at a time, then the arguments
+        # which are printed for 'extern "C"' functions of C++ units
+        head = printable.split("(", 1)[0]
+        candidates = [printable] + [
+            printable[i + 1:] for i, c in enumerate(head) if c == " "]
+        candidates += [c.split("(", 1)[0] for c in candidates if "(" in c]
+        for candidate in candidates:
+            if candidate in by_name:
+                for name in by_name[candidate]:
+                    result[name] = frame
+                break
+    return result
+
+
+def _function_symbols(elf):
+    return sorted(
+        (s for s in elf.symbols() if s.type == STT_FUNC and s.size),
+        key=lambda s: s.value)
+
+
+def _code(elf, address, size):
+    for section in elf.sections:
+        if section.type != SHT_NOBITS and section.addr <= address and (
+                address + size <= section.addr + section.size) and (
+                section.size):
+            start = section.offset + address - section.addr
+            return elf.data[start:start + size]
+    return b""
+
+
+def _thumb_calls(code, address):
+    pos = 0
+    while pos + 2 <= len(code):
+        hw1 = struct.unpack_from("<H", code, pos)[0]
+        if hw1 >> 11 in (0x1D, 0x1E, 0x1F) and pos + 4 <= len(code):
+            hw2 = struct.unpack_from("<H", code, pos + 2)[0]
+            # BL and B.W (tail call)
+            if hw1 >> 11 == 0x1E and hw2 & 0xD000 in (0xD000, 0x9000):
+                s = (hw1 >> 10) & 1
+                i1 = 1 - (((hw2 >> 13) & 1) ^ s)
+                i2 = 1 - (((hw2 >> 11) & 1) ^ s)
+                offset = (s << 24 | i1 << 23 | i2 << 22 |
+                          (hw1 & 0x3FF) << 12 | (hw2 & 0x7FF) << 1)
+                if s:
+                    offset -= 1 << 25
+                yield address + pos + 4 + offset
+            pos += 4
+            continue
+        if hw1 & 0xFF87 == 0x4780:  # BLX Rm
+            yield None
+        pos += 2
+
+
+def _avr_calls(code, address):
+    pos = 0
+    while pos + 2 <= len(code):
+        word = struct.unpack_from("<H", code, pos)[0]
+        if word & 0xFE0C == 0x940C and pos + 4 <= len(code):  # call/jmp
+            target = ((word & 0x1F0) << 13 | (word & 1) << 16 |
+                      struct.unpack_from("<H", code, pos + 2)[0])
+            yield target * 2
+            pos += 4
+            continue
+        if word & 0xFC0F == 0x9000 and pos + 4 <= len(code):  # lds/sts
+            pos += 4
+            continue
+        if word & 0xE000 == 0xC000:  # rcall/rjmp
+            offset = word & 0xFFF
+            if offset & 0x800:
+                offset -= 0x1000
+            yield address + pos + 2 + offset * 2
+        elif word in (0x9509, 0x9519):  # icall/eicall
+            yield None
+        pos += 2
+
+
+def elf_call_graph(elf_path, frames=None):
+    """Call graph from the direct calls in the code of every function"""
+    graph = CallGraph()
+    with ElfFile(elf_path) as elf:
+        decoder = _avr_calls if elf.machine == EM_AVR else _thumb_calls
+        functions = _function_symbols(elf)
+        starts = {}
+        for symbol in functions:
+            starts.setdefault(symbol.value & ~1, symbol.name)
+        for symbol in functions:
+            address = symbol.value & ~1
+            for target in decoder(_code(elf, address, symbol.size), address):
+                if target is None:
+                    graph.add_call(symbol.name, INDIRECT_CALL)
+                elif target in starts and target != address:
+                    graph.add_call(symbol.name, starts[target])
+    for name, (size, qualifier) in (frames or {}).items():
+        graph.add_frame(name, size, qualifier)
+    return graph
+
+
+def find_entry_points(elf_path):
+    """Return (reset handler, [interrupt handlers]) of the firmware"""
+    with ElfFile(elf_path) as elf:
+        functions = _function_symbols(elf)
+        names = set(s.name for s in functions)
+        by_address = {}
+        for symbol in functions:
+            by_address.setdefault(symbol.value & ~1, symbol.name)
+        isrs = set(name for name in names if ISR_NAME_RE.match(name))
+        tables = [s for s in elf.symbols()
+                  if s.name in VECTOR_TABLES and s.size]
+        if tables and elf.machine == EM_ARM:
+            data = _code(elf, tables[0].value, tables[0].size)
+            # the first entry is the initial stack pointer
+            for (address,) in list(struct.iter_unpack("<I", data))[1:]:
+                if address & ~1 in by_address:
+                    isrs.add(by_address[address & ~1])
+    reset = next((name for name in RESET_HANDLERS if name in names), None)
+    isrs.discard(reset)
+    return reset, sorted(isrs)
+
+
+def worst_case(graph, entry):
+    """
+    Return (depth, path, notes) of the deepest call chain from `entry`.
+    Notes list recursion, indirect calls, dynamic frames and functions
+    without stack information, all of which make the result a lower bound.
+    """
+    notes = set()
+    memo = {}
+
+    def _visit(name, active):
+        if name in memo:
+            return memo[name]
+        if name == INDIRECT_CALL:
+            notes.add("indirect call")
+            return 0, []
+        size, qualifier = graph.frames.get(name, (0, None))
+        if qualifier is None:
+            notes.add("no stack info: %s" % name)
+        elif qualifier != "static" and "bounded" not in qualifier:
+            notes.add("dynamic frame: %s" % name)
+        best = (0, [])
+        active.add(name)
+        for callee in sorted(graph.calls.get(name, [])):
+            if callee in active:
+                notes.add("recursion: %s" % callee)
+                continue
+            depth, path = _visit(callee, active)
+            if depth > best[0]:
+                best = (depth, path)
+        active.discard(name)
+        memo[name] = (size + best[0], [name] + best[1])
+        return memo[name]
+
+    depth, path = _visit(entry, set())
+    return depth, path, sorted(notes)
+
+
+def analyze(graph, elf_path, exception_frame=0, nesting=1):
+    """
+    Worst case = deepest reset path + the `nesting` deepest interrupt
+    handlers, each with the hardware exception frame on top.
+    """
+    reset, isrs = find_entry_points(elf_path)
+    entries = []
+    for name in ([reset] if reset else []) + isrs:
+        depth, path, notes = worst_case(graph, name)
+        if name != reset:
+            depth += exception_frame
+        entries.append(dict(
+            name=name, kind="reset" if name == reset else "isr",
+            depth=depth, path=path, notes=notes))
+    reset_depth = sum(e["depth"] for e in entries if e["kind"] == "reset")
+    isr_depths = sorted(
+        (e["depth"] for e in entries if e["kind"] == "isr"), reverse=True)
+    return dict(
+        entries=entries,
+        worst_case=reset_depth + sum(isr_depths[:nesting]))
@@ -0,0 +1,316 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compiled SQLite index of CMSIS-SVD register descriptions.
+
+The SVD is parsed once with a streaming parser, one peripheral at a time,
+and stored as peripherals -> registers -> fields with absolute offsets
+(register arrays are expanded). Readers load a single peripheral on demand,
+so opening the index costs the same for any SVD size.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+from collections import namedtuple
+from os.path import basename, isdir, isfile, join
+from xml.etree import ElementTree
+
+SCHEMA_VERSION = 1
+INDEX_SUFFIX = ".sqlite"
+REGISTER_PROPERTIES = ("size", "access", "resetValue")
+
+Peripheral = namedtuple(
+    "Peripheral", "name base_address group description registers")
+Register = namedtuple(
+    "Register",
+    "name offset size access reset_value read_action description fields")
+Field = namedtuple(
+    "Field", "name bit_offset bit_width access read_action description enums")
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE peripherals (
+    id INTEGER PRIMARY KEY, name TEXT UNIQUE, base_address INTEGER,
+    group_name TEXT, derived_from TEXT, description TEXT);
+CREATE TABLE registers (
+    id INTEGER PRIMARY KEY, peripheral_id INTEGER, name TEXT,
+    offset INTEGER, size INTEGER, access TEXT, reset_value INTEGER,
+    read_action TEXT, description TEXT);
+CREATE TABLE fields (
+    register_id INTEGER, name TEXT, bit_offset INTEGER, bit_width INTEGER,
+    access TEXT, read_action TEXT, description TEXT, enums TEXT);
+CREATE INDEX registers_peripheral ON registers (peripheral_id);
+CREATE INDEX fields_register ON fields (register_id);
+"""
+
+
+def _int(text):
+    text = text.strip().lower()
+    if text.startswith("0x"):
+        return int(text, 16)
+    if text.startswith("#"):
+        # binary with optional "x" (don't care) bits
+        return int(text[1:].replace("x", "0"), 2)
+    return int(text, 10)
+
+
+def _text(elem, name, default=None):
+    value = elem.findtext(name)
+    return " ".join(value.split()) if value is not None else default
+
+
+def _properties(elem, defaults):
+    result = dict(defaults)
+    for name in REGISTER_PROPERTIES:
+        value = _text(elem, name)
+        if value is not None:
+            result[name] = value
+    return result
+
+
+def _dim(elem, name):
+    """Yield (name, address increment) for every element of an SVD array"""
+    if elem.find("dim") is None:
+        yield name, 0
+        return
+    count = _int(elem.findtext("dim"))
+    increment = _int(elem.findtext("dimIncrement"))
+    indexes = [str(i) for i in range(count)]
+    dim_index = _text(elem, "dimIndex")
+    if dim_index and "-" in dim_index and "," not in dim_index:
+        first, last = dim_index.split("-")
+        if first.isdigit():
+            indexes = [str(i) for i in range(int(first), int(last) + 1)]
+        else:
+            indexes = [chr(i) for i in range(ord(first), ord(last) + 1)]
+    elif dim_index:
+        indexes = [i.strip() for i in dim_index.split(",")]
+    for i, index in enumerate(indexes[:count]):
+        yield name.replace("[%s]", index).replace("%s", index), i * increment
+
+
+def _fields(register_elem, access):
+    for elem in register_elem.iterfind("fields/field"):
+        if elem.find("bitOffset") is not None:
+            offset = _int(elem.findtext("bitOffset"))
+            width = _int(elem.findtext("bitWidth", "1"))
+        elif elem.find("lsb") is not None:
+            offset = _int(elem.findtext("lsb"))
+            width = _int(elem.findtext("msb")) - offset + 1
+        else:
+            msb, lsb = elem.findtext("bitRange").strip("[] ").split(":")
+            offset = _int(lsb)
+            width = _int(msb) - offset + 1
+        enums = {}
+        for value in elem.iterfind("enumeratedValues/enumeratedValue"):
+            if value.find("value") is not None:
+                try:
+                    enums[_int(value.findtext("value"))] = _text(value, "name")
+                except ValueError:
+                    pass
+        for name, _ in _dim(elem, _text(elem, "name")):
+            yield (name, offset, width, _text(elem, "access", access),
+                   _text(elem, "readAction"), _text(elem, "description"),
+                   json.dumps(enums) if enums else None)
+
+
+def _registers(parent, defaults, base_offset=0, prefix=""):
+    for elem in parent:
+        if elem.tag == "cluster":
+            props = _properties(elem, defaults)
+            for name, increment in _dim(elem, _text(elem, "name")):
+                for item in _registers(
+                        elem, props,
+                        base_offset + _int(elem.findtext("addressOffset")) +
+                        increment, prefix + name + "_"):
+                    yield item
+        elif elem.tag == "register":
+            props = _properties(elem, defaults)
+            offset = base_offset + _int(elem.findtext("addressOffset"))
+            fields = list(_fields(elem, props.get("access")))
+            for name, increment in _dim(elem, _text(elem, "name")):
+                yield (prefix + name, offset + increment,
+                       _int(props.get("size", "32")), props.get("access"),
+                       _int(props["resetValue"])
+                       if "resetValue" in props else None,
+                       _text(elem, "readAction"), _text(elem, "description"),
+                       fields)
+
+
+def _source_stamp(svd_path):
+    st = os.stat(svd_path)
+    return json.dumps([SCHEMA_VERSION, st.st_size, int(st.st_mtime)])
+
+
+def compile_svd(svd_path, index_path):
+    tmp_path = "%s.%d.tmp" % (index_path, os.getpid())
+    if isfile(tmp_path):
+        os.remove(tmp_path)
+    db = sqlite3.connect(tmp_path)
+    try:
+        db.executescript(SCHEMA)
+        device_defaults = {}
+        peripherals_elem = None
+        depth = 0
+        for event, elem in ElementTree.iterparse(
+                svd_path, events=("start", "end")):
+            if event == "start":
+                depth += 1
+                if depth == 2 and elem.tag == "peripherals":
+                    peripherals_elem = elem
+                continue
+            depth -= 1
+            if depth == 1 and elem.tag in REGISTER_PROPERTIES:
+                device_defaults[elem.tag] = elem.text.strip()
+            elif depth == 2 and elem.tag == "peripheral":
+                _store_peripheral(db, elem, device_defaults)
+                # drop the parsed subtree, only one peripheral is kept
+                peripherals_elem.clear()
+        db.execute(
+            "INSERT INTO meta VALUES ('source', ?)",
+            (_source_stamp(svd_path),))
+        db.commit()
+    finally:
+        db.close()
+    os.replace(tmp_path, index_path)
+    return index_path
+
+
+def _store_peripheral(db, elem, device_defaults):
+    cursor = db.execute(
+        "INSERT INTO peripherals (name, base_address, group_name, "
+        "derived_from, description) VALUES (?, ?, ?, ?, ?)",
+        (_text(elem, "name"), _int(elem.findtext("baseAddress")),
+         _text(elem, "groupName"), elem.get("derivedFrom"),
+         _text(elem, "description")))
+    peripheral_id = cursor.lastrowid
+    registers_elem = elem.find("registers")
+    if registers_elem is None:
+        return
+    for item in _registers(
+            registers_elem, _properties(elem, device_defaults)):
+        register_id = db.execute(
+            "INSERT INTO registers (peripheral_id, name, offset, size, "
+            "access, reset_value, read_action, description) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (peripheral_id,) + item[:-1]).lastrowid
+        db.executemany(
+            "INSERT INTO fields VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(register_id,) + field for field in item[-1]])
+
+
+def _is_current(index_path, svd_path):
+    if not isfile(index_path):
+        return False
+    try:
+        db = sqlite3.connect(index_path)
+        try:
+            row = db.execute(
+                "SELECT value FROM meta WHERE key = 'source'").fetchone()
+        finally:
+            db.close()
+    except sqlite3.Error:
+        return False
+    return bool(row) and row[0] == _source_stamp(svd_path)
+
+
+def get_index_path(svd_path, index_dir):
+    """
+    Return a current index for `svd_path` in `index_dir`, compiling it if
+    needed. The name holds a hash of the SVD location, so equally named
+    SVDs of different projects keep their own index.
+    """
+    svd_path = os.path.abspath(svd_path)
+    index_path = join(index_dir, "%s.%s%s" % (
+        basename(svd_path),
+        hashlib.sha1(svd_path.encode("utf-8")).hexdigest()[:10],
+        INDEX_SUFFIX))
+    if _is_current(index_path, svd_path):
+        return index_path
+    try:
+        if not isdir(index_dir):
+            os.makedirs(index_dir)
+        return compile_svd(svd_path, index_path)
+    except (OSError, sqlite3.Error):
+        return None
+
+
+class SvdIndex(object):
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path)
+        self._peripherals = {}
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def peripheral_names(self):
+        return [row[0] for row in self._db.execute(
+            "SELECT name FROM peripherals ORDER BY base_address")]
+
+    def find_peripheral(self, address):
+        """Return the name of the peripheral with the nearest lower base"""
+        row = self._db.execute(
+            "SELECT name FROM peripherals WHERE base_address <= ? "
+            "ORDER BY base_address DESC LIMIT 1", (address,)).fetchone()
+        return row[0] if row else None
+
+    def peripheral(self, name):
+        if name in self._peripherals:
+            return self._peripherals[name]
+        row = self._db.execute(
+            "SELECT id, base_address, group_name, derived_from, description "
+            "FROM peripherals WHERE name = ?", (name,)).fetchone()
+        if not row:
+            raise KeyError(name)
+        peripheral_id, base_address, group, derived_from, description = row
+        if derived_from:
+            base = self.peripheral(derived_from)
+            registers = base.registers
+            group = group or base.group
+            description = description or base.description
+        else:
+            registers = self._load_registers(peripheral_id)
+        result = Peripheral(name, base_address, group, description, registers)
+        self._peripherals[name] = result
+        return result
+
+    def _load_registers(self, peripheral_id):
+        fields = {}
+        for row in self._db.execute(
+                "SELECT f.register_id, f.name, f.bit_offset, f.bit_width, "
+                "f.access, f.read_action, f.description, f.enums "
+                "FROM fields f JOIN registers r ON r.id = f.register_id "
+                "WHERE r.peripheral_id = ? ORDER BY f.bit_offset",
+                (peripheral_id,)):
+            fields.setdefault(row[0], []).append(Field(*row[1:-1], enums={
+                int(k): v for k, v in json.loads(row[-1]).items()
+            } if row[-1] else {}))
+        return [
+            Register(*row[1:], fields=fields.get(row[0], []))
+            for row in self._db.execute(
+                "SELECT id, name, offset, size, access, reset_value, "
+                "read_action, description FROM registers "
+                "WHERE peripheral_id = ? ORDER BY offset, id",
+                (peripheral_id,))]
@@ -0,0 +1,66 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Content hashes of the firmware images last uploaded to each device.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from os.path import dirname, isdir, isfile
+
+
+def image_hash(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class UploadState(object):
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if not isfile(self.path):
+            return {}
+        try:
+            with open(self.path) as fp:
+                return json.load(fp)
+        except ValueError:
+            return {}
+
+    def get(self, device):
+        return self._load().get(device, {}).get("hash")
+
+    def is_current(self, device, digest):
+        return self.get(device) == digest
+
+    def record(self, device, digest, **extra):
+        with self._lock:
+            data = self._load()
+            data[device] = dict(extra, hash=digest, time=int(time.time()))
+            if not isdir(dirname(self.path)):
+                os.makedirs(dirname(self.path))
+            tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+            with open(tmp_path, "w") as fp:
+                json.dump(data, fp, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+
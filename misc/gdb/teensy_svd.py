@@ -0,0 +1,106 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+GDB peripheral view backed by the compiled SVD index ("builder/svdindex.py").
+
+    teensy-svd-load <builder dir> <index path>
+    teensy-svd                      list peripherals
+    teensy-svd <PERIPHERAL>         read and decode all registers
+
+Registers are fetched with the reads planned by "builder/regplan.py", runs
+of 32-bit registers as one block and narrower registers one by one.
+"""
+
+import sys
+
+import gdb  # pylint: disable=import-error
+
+_index = None
+_regplan = None
+
+
+def _read_block(inferior, read):
+    # word aligned blocks are read with 32-bit accesses, 8- and 16-bit
+    # registers need accesses of their own width
+    if read.width == 4:
+        return bytes(inferior.read_memory(read.address, read.size))
+    return b"".join(
+        bytes(inferior.read_memory(read.address + offset, read.width))
+        for offset in range(0, read.size, read.width))
+
+
+class TeensySvdLoad(gdb.Command):
+
+    def __init__(self):
+        super().__init__("teensy-svd-load", gdb.COMMAND_DATA)
+
+    def invoke(self, argument, from_tty):
+        global _index, _regplan  # pylint: disable=global-statement
+        builder_dir, index_path = gdb.string_to_argv(argument)
+        if builder_dir not in sys.path:
+            sys.path.insert(0, builder_dir)
+        try:
+            # pylint: disable=import-outside-toplevel
+            import regplan
+            import svdindex
+        except ImportError as e:
+            # e.g. the Python of GDB is built without sqlite3
+            gdb.write("Warning! Peripheral view is not available: %s\n" % e)
+            return
+
+        _index = svdindex.SvdIndex(index_path)
+        _regplan = regplan
+
+
+class TeensySvd(gdb.Command):
+    """Show peripheral registers described by the board SVD"""
+
+    def __init__(self):
+        super().__init__("teensy-svd", gdb.COMMAND_DATA)
+
+    def invoke(self, argument, from_tty):
+        if not _index:
+            raise gdb.GdbError("SVD index is not loaded")
+        name = argument.strip()
+        if not name:
+            for item in _index.peripheral_names():
+                gdb.write("%s\n" % item)
+            return
+        try:
+            peripheral = _index.peripheral(name)
+        except KeyError:
+            raise gdb.GdbError("Unknown peripheral %s" % name)
+        reads = _regplan.plan(peripheral)
+        inferior = gdb.selected_inferior()
+        data = [_read_block(inferior, read) for read in reads]
+        decoded = {
+            register.name: (value, fields) for register, value, fields in
+            _regplan.decode(peripheral, reads, data)}
+        for register in peripheral.registers:
+            address = peripheral.base_address + register.offset
+            if register.name not in decoded:
+                gdb.write("%-16s 0x%08X  (not read)\n" % (
+                    register.name, address))
+                continue
+            value, fields = decoded[register.name]
+            gdb.write("%-16s 0x%08X  0x%0*X\n" % (
+                register.name, address, register.size // 4, value))
+            for field, field_value in fields:
+                gdb.write("  %-14s %#x %s\n" % (
+                    field.name, field_value, field.enums.get(field_value, "")))
+
+
+TeensySvdLoad()
+TeensySvd()
@@ -0,0 +1,62 @@
+/*
+ * Copyright 2014-present PlatformIO <contact@platformio.org>
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+#include <Arduino.h>
+#include <gcov.h>
+#include <stdlib.h>
+
+#include "teensy_pgo.h"
+
+/* Pointers to the gcov_info objects, placed by -fprofile-info-section */
+extern "C" const struct gcov_info *const __start_teensy_gcov_info[];
+extern "C" const struct gcov_info *const __stop_teensy_gcov_info[];
+
+static void pgo_write(const void *data, unsigned length, void *)
+{
+    static const char digits[] = "0123456789abcdef";
+    const unsigned char *bytes = (const unsigned char *)data;
+    for (unsigned i = 0; i < length; i++) {
+        Serial.write(digits[bytes[i] >> 4]);
+        Serial.write(digits[bytes[i] & 0x0f]);
+    }
+}
+
+static void pgo_filename(const char *filename, void *arg)
+{
+    __gcov_filename_to_gcfn(filename, pgo_write, arg);
+}
+
+static void *pgo_allocate(unsigned length, void *)
+{
+    return malloc(length);
+}
+
+void teensy_pgo_dump(void)
+{
+    const struct gcov_info *const *info = __start_teensy_gcov_info;
+    const struct gcov_info *const *end = __stop_teensy_gcov_info;
+
+    /* keep the compiler from assuming that both arrays are distinct */
+    __asm__("" : "+r"(info));
+    Serial.println("#pgo-begin");
+    while (info != end) {
+        __gcov_info_to_gcda(*info, pgo_filename, pgo_write, pgo_allocate, NULL);
+        Serial.println();
+        info++;
+    }
+    Serial.println("#pgo-end");
+    Serial.flush();
+}
@@ -0,0 +1,35 @@
+/*
+ * Copyright 2014-present PlatformIO <contact@platformio.org>
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+#ifndef TEENSY_PGO_H
+#define TEENSY_PGO_H
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+/*
+ * Write the collected profile counters to the USB serial port. Call it once
+ * the training workload has finished, "pio run -t pgocollect" stores the
+ * dump as .gcda files for the "board_build.arduino.pgo = use" build.
+ */
+void teensy_pgo_dump(void);
+
+#ifdef __cplusplus
+}
+#endif
+
+#endif
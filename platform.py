@@ -12,9 +12,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import importlib.util
+import json
+import os
 import sys
 
 from platformio.public import PlatformBase
+from platformio.project.config import ProjectConfig
 
 
 IS_WINDOWS = sys.platform.startswith("win")
@@ -22,47 +26,93 @@ IS_WINDOWS = sys.platform.startswith("win")
 
 class TeensyPlatform(PlatformBase):
 
+    _PACKAGE_PLANS = {}
+
     def configure_default_packages(self, variables, targets):
+        board = variables.get("board")
+        key = json.dumps([
+            self.version, board, sorted(variables.get("pioframework", [])),
+            variables.get("upload_protocol", ""),
+            variables.get("debug_tool", ""), sorted(self.packages)])
+        plan = self._get_package_plan(key, variables)
+        for name in plan["remove"]:
+            self.packages.pop(name, None)
+        for name in plan["required"]:
+            if name in self.packages:
+                self.packages[name]["optional"] = False
+
+        if os.environ.get("PLATFORMIO_TEENSY_DEBUG_PACKAGES"):
+            for name, action, reason in plan["reasons"]:
+                sys.stderr.write("%-35s %-8s %s\n" % (name, action, reason))
+
+        return super().configure_default_packages(variables, targets)
+
+    def _get_package_plan(self, key, variables):
+        if key in self._PACKAGE_PLANS:
+            return self._PACKAGE_PLANS[key]
+
+        plan = self._resolve_package_plan(variables)
+        self._PACKAGE_PLANS[key] = plan
+        return plan
+
+    def _resolve_package_plan(self, variables):
+        remove = []
+        required = []
+        reasons = []
+
+        def _remove(name, reason):
+            if name in self.packages and name not in remove:
+                remove.append(name)
+                reasons.append((name, "dropped", reason))
+
+        def _require(name, reason):
+            if name in self.packages and name not in remove:
+                required.append(name)
+                reasons.append((name, "required", reason))
+
+        build_core = ""
+        board_config = None
         if variables.get("board"):
             board_config = self.board_config(variables.get("board"))
-            del_toolchain = "toolchain-gccarmnoneeabi"
-            if board_config.get("build.core") != "teensy":
-                del_toolchain = "toolchain-atmelavr"
-            if del_toolchain in self.packages:
-                del self.packages[del_toolchain]
+            build_core = board_config.get("build.core", "")
+            if build_core != "teensy":
+                _remove("toolchain-atmelavr", "ARM core '%s'" % build_core)
+            else:
+                _remove("toolchain-gccarmnoneeabi", "AVR core")
 
         frameworks = variables.get("pioframework", [])
         if "arduino" in frameworks:
-            self.packages.pop("toolchain-gccarmnoneeabi", None)
+            _remove("toolchain-gccarmnoneeabi",
+                    "Arduino uses toolchain-gccarmnoneeabi-teensy")
         else:
-            self.packages["toolchain-gccarmnoneeabi"]["optional"] = False
-            self.packages.pop("toolchain-gccarmnoneeabi-teensy", None)
+            _require("toolchain-gccarmnoneeabi", "non-Arduino build")
+            _remove("toolchain-gccarmnoneeabi-teensy", "non-Arduino build")
 
         if "zephyr" in frameworks:
-            for p in self.packages:
-                if p in ("tool-cmake", "tool-dtc", "tool-ninja"):
-                    self.packages[p]["optional"] = False
+            for name in ("tool-cmake", "tool-dtc", "tool-ninja"):
+                _require(name, "Zephyr build system")
             if not IS_WINDOWS:
-                self.packages["tool-gperf"]["optional"] = False
-        elif "arduino" in frameworks and board_config.get("build.core", "") == "teensy4":
-            self.packages["tool-teensy"]["optional"] = False
+                _require("tool-gperf", "Zephyr build system")
+        elif "arduino" in frameworks and build_core == "teensy4":
+            _require("tool-teensy", "teensy_size for teensy4 core")
 
         # configure J-LINK tool
         jlink_conds = [
             "jlink" in variables.get(option, "")
             for option in ("upload_protocol", "debug_tool")
         ]
-        if variables.get("board"):
-            board_config = self.board_config(variables.get("board"))
+        if board_config:
             jlink_conds.extend([
                 "jlink" in board_config.get(key, "")
                 for key in ("debug.default_tools", "upload.protocol")
             ])
-        jlink_pkgname = "tool-jlink"
-        if not any(jlink_conds) and jlink_pkgname in self.packages:
-            del self.packages[jlink_pkgname]
+        if not any(jlink_conds):
+            _remove("tool-jlink", "J-Link is not used for upload or debug")
 
-        return super().configure_default_packages(variables, targets)
+        for name in self.packages:
+            if name not in remove and name not in required:
+                reasons.append((name, "kept", "default"))
+        return dict(remove=remove, required=required, reasons=reasons)
 
     def get_boards(self, id_=None):
         result = super().get_boards(id_)
@@ -110,3 +160,43 @@ class TeensyPlatform(PlatformBase):
                 debug_config.server["arguments"].extend(
                     ["-speed", debug_config.speed]
                 )
+
+        # GDB without Python would stop at the commands, they are opt-in
+        svd_commands = self._load_builder_module("boolopt").is_enabled(
+            debug_config.board_config.get("debug.svd_commands", "no"))
+        svd_index_path = svd_commands and self._get_svd_index_path(
+            debug_config)
+        if svd_index_path:
+            # copy, the tool settings are shared with the cached board config
+            debug_config.tool_settings = dict(
+                debug_config.tool_settings,
+                extra_cmds=debug_config.cleanup_cmds(
+                    debug_config.tool_settings.get("extra_cmds")) + [
+                    "source %s" % os.path.join(
+                        self.get_dir(), "misc", "gdb", "teensy_svd.py"),
+                    'teensy-svd-load "%s" "%s"' % (
+                        os.path.join(self.get_dir(), "builder"),
+                        svd_index_path)
+                ])
+
+    def _get_svd_index_path(self, debug_config):
+        svd_path = debug_config.env_options.get(
+            "debug_svd_path", debug_config.board_config.get(
+                "debug.svd_path", ""))
+        if svd_path and not os.path.isfile(svd_path):
+            svd_path = os.path.join(self.get_dir(), "misc", "svd", svd_path)
+        if not os.path.isfile(svd_path):
+            return None
+        svdindex = self._load_builder_module("svdindex")
+        return svdindex.get_index_path(svd_path, os.path.join(
+            ProjectConfig.get_instance().get("platformio", "cache_dir"),
+            "teensy", "svd"))
+
+    def _load_builder_module(self, name):
+        # "builder" is not importable outside of SCons
+        spec = importlib.util.spec_from_file_location(
+            "teensy_%s" % name,
+            os.path.join(self.get_dir(), "builder", "%s.py" % name))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module